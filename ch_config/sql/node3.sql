@@ -26,4 +26,79 @@ CREATE TABLE IF NOT EXISTS default.view(
     end_time UInt16,
     event_time DateTime DEFAULT now()
 )
-Engine=Distributed('company_cluster', '', view, rand());
\ No newline at end of file
+-- Ключ шардирования совпадает с раскладкой строк по шардам в ETL
+Engine=Distributed('company_cluster', '', view, CRC32(user_id));
+
+-- Последняя позиция просмотра по паре user_id/film_id. ETL пишет сюда
+-- свернутые батчи, ReplacingMergeTree оставляет строку с наибольшим
+-- event_time при слиянии кусков
+CREATE TABLE IF NOT EXISTS shard.view_latest(
+    user_id String,
+    film_id String,
+    start_time UInt16,
+    end_time UInt16,
+    event_time DateTime
+)
+Engine=ReplicatedReplacingMergeTree('/clickhouse/tables/shard2/view_latest', 'replica_1', event_time) ORDER BY (user_id, film_id);
+
+CREATE TABLE IF NOT EXISTS replica.view_latest(
+    user_id String,
+    film_id String,
+    start_time UInt16,
+    end_time UInt16,
+    event_time DateTime
+)
+Engine=ReplicatedReplacingMergeTree('/clickhouse/tables/shard1/view_latest', 'replica_2', event_time) ORDER BY (user_id, film_id);
+
+-- Все позиции пользователя хранятся на одном шарде
+CREATE TABLE IF NOT EXISTS default.view_latest(
+    user_id String,
+    film_id String,
+    start_time UInt16,
+    end_time UInt16,
+    event_time DateTime
+)
+Engine=Distributed('company_cluster', '', view_latest, CRC32(user_id));
+
+-- Последняя позиция просмотра по паре user_id/film_id для сервиса.
+-- Materialized view сворачивает каждую вставку в view до состояний
+-- argMax, AggregatingMergeTree объединяет их при слиянии кусков, а при
+-- чтении недослитые куски объединяет argMaxMerge
+CREATE TABLE IF NOT EXISTS shard.view_position(
+    user_id String,
+    film_id String,
+    position AggregateFunction(argMax, Tuple(UInt16, UInt16, DateTime), DateTime)
+)
+Engine=ReplicatedAggregatingMergeTree('/clickhouse/tables/shard2/view_position', 'replica_1') ORDER BY (user_id, film_id);
+
+CREATE TABLE IF NOT EXISTS replica.view_position(
+    user_id String,
+    film_id String,
+    position AggregateFunction(argMax, Tuple(UInt16, UInt16, DateTime), DateTime)
+)
+Engine=ReplicatedAggregatingMergeTree('/clickhouse/tables/shard1/view_position', 'replica_2') ORDER BY (user_id, film_id);
+
+-- Срабатывает на вставки в локальную таблицу, в том числе через
+-- Distributed-таблицу и напрямую из ETL
+CREATE MATERIALIZED VIEW IF NOT EXISTS shard.view_position_mv TO shard.view_position AS
+SELECT
+    user_id,
+    film_id,
+    argMaxState((start_time, end_time, event_time), event_time) AS position
+FROM shard.view
+GROUP BY user_id, film_id;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS replica.view_position_mv TO replica.view_position AS
+SELECT
+    user_id,
+    film_id,
+    argMaxState((start_time, end_time, event_time), event_time) AS position
+FROM replica.view
+GROUP BY user_id, film_id;
+
+CREATE TABLE IF NOT EXISTS default.view_position(
+    user_id String,
+    film_id String,
+    position AggregateFunction(argMax, Tuple(UInt16, UInt16, DateTime), DateTime)
+)
+Engine=Distributed('company_cluster', '', view_position, CRC32(user_id));
@@ -4,4 +4,4 @@ set -o errexit
 set -o pipefail
 set -o nounset
 
-python src/main.py
\ No newline at end of file
+exec python src/supervisor.py
\ No newline at end of file
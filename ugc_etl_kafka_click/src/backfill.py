@@ -0,0 +1,315 @@
+"""Повторная загрузка диапазона топика в ClickHouse.
+
+Партиции читаются параллельно процессами без группы потребителей, офсеты
+не фиксируются, поэтому загрузка не мешает работающему ETL.
+
+Запуск из каталога src:
+    python backfill.py --from-time 2023-05-01T00:00 --to-time 2023-05-02
+    python backfill.py --from-offset 0 --to-offset 100000 --partitions 0 1
+    python backfill.py --from-time 2023-05-01 --table default.view_v2
+"""
+import argparse
+import multiprocessing
+import os
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from logging import getLogger
+from queue import Empty
+from typing import Dict, List, Optional, Set, Tuple
+
+from kafka import KafkaConsumer
+from kafka.structs import TopicPartition
+
+from core.config import settings
+from extract.decode import decode_records
+from extract.schema import ViewBatch, ViewBlock
+from load.base import ClickhouseLoader
+from transform.base import Transformer
+
+
+logger = getLogger(__name__)
+
+
+class BackfillError(Exception):
+    pass
+
+
+@dataclass
+class PartitionRange:
+    partition: int
+    start: int
+    # Не включается
+    end: int
+
+
+@dataclass
+class Progress:
+    partition: int
+    messages: int
+    rows: int
+    invalid: int
+    done: bool = False
+
+
+def create_consumer() -> KafkaConsumer:
+    # Без group_id консьюмер не входит в группу и не фиксирует офсеты
+    return KafkaConsumer(
+        bootstrap_servers=settings.kafka_server,
+        group_id=None,
+        enable_auto_commit=False,
+        max_partition_fetch_bytes=16 * 1024 * 1024,
+        fetch_max_bytes=64 * 1024 * 1024
+    )
+
+
+def timestamp_ms(value: str) -> int:
+    return int(datetime.fromisoformat(value).timestamp() * 1000)
+
+
+def resolve_ranges(
+    consumer: KafkaConsumer,
+    topic: str,
+    partitions: Optional[List[int]],
+    from_offset: Optional[int],
+    to_offset: Optional[int],
+    from_time: Optional[str],
+    to_time: Optional[str]
+) -> List[PartitionRange]:
+    """Диапазоны офсетов партиций. Конец диапазона ограничен highwater на
+    момент запуска: новые сообщения загрузит основной ETL."""
+    if partitions is None:
+        partitions = sorted(consumer.partitions_for_topic(topic) or ())
+    topic_partitions = [TopicPartition(topic, p) for p in partitions]
+    beginning = consumer.beginning_offsets(topic_partitions)
+    end = consumer.end_offsets(topic_partitions)
+
+    def by_time(value: str, default: Dict[TopicPartition, int]):
+        found = consumer.offsets_for_times(
+            {tp: timestamp_ms(value) for tp in topic_partitions}
+        )
+        return {
+            tp: found[tp].offset if found.get(tp) else default[tp]
+            for tp in topic_partitions
+        }
+
+    starts = beginning
+    if from_time:
+        starts = by_time(from_time, end)
+    stops = end
+    if to_time:
+        stops = by_time(to_time, end)
+
+    ranges = []
+    for tp in topic_partitions:
+        start = max(starts[tp], beginning[tp])
+        if from_offset is not None:
+            start = max(start, from_offset)
+        stop = stops[tp]
+        if to_offset is not None:
+            stop = min(stop, to_offset)
+        if start < stop:
+            ranges.append(PartitionRange(tp.partition, start, stop))
+    return ranges
+
+
+def load_partition(
+    consumer: KafkaConsumer,
+    transformer: Transformer,
+    loader: ClickhouseLoader,
+    table: str,
+    partition_range: PartitionRange,
+    batch_rows: int,
+    progress: multiprocessing.Queue,
+    stall_timeout: float
+) -> None:
+    """Загружает диапазон партиции. Если начало диапазона уже удалено
+    из топика или за stall_timeout секунд чтение не продвинулось,
+    выбрасывает BackfillError."""
+    tp = TopicPartition(settings.kafka_topic, partition_range.partition)
+    consumer.assign([tp])
+    # Диапазон мог устареть с момента запуска: чтение с удаленного офсета
+    # сбросило бы позицию в конец партиции
+    beginning = consumer.beginning_offsets([tp])[tp]
+    if beginning > partition_range.start:
+        raise BackfillError(
+            f'Партиция {partition_range.partition}: офсеты '
+            f'[{partition_range.start}, {beginning}) удалены из топика'
+        )
+    consumer.seek(tp, partition_range.start)
+    position = partition_range.start
+    stalled_since = time.monotonic()
+    while position < partition_range.end:
+        part = ViewBatch()
+        first = position
+        last = position
+        messages = invalid = 0
+        while len(part) < batch_rows and position < partition_range.end:
+            records = consumer.poll(
+                timeout_ms=1000,
+                max_records=batch_rows - len(part)
+            ).get(tp, [])
+            records = [
+                record for record in records
+                if record.offset < partition_range.end
+            ]
+            if records:
+                invalid += len(decode_records(records, part))
+                messages += len(records)
+                last = records[-1].offset
+            # Позиция учитывает пропуски офсетов (служебные записи)
+            previous, position = position, consumer.position(tp)
+            now = time.monotonic()
+            if position != previous:
+                stalled_since = now
+            elif now - stalled_since > stall_timeout:
+                raise BackfillError(
+                    f'Партиция {partition_range.partition}: нет сообщений '
+                    f'на офсете {position} за {stall_timeout} с, конец '
+                    f'диапазона {partition_range.end}'
+                )
+
+        if part:
+            part.blocks.append(ViewBlock(tp, first, last, 0, len(part)))
+            for data in transformer.transform_batch(part, table):
+                loader.load(data)
+        progress.put(Progress(
+            partition_range.partition, messages, len(part), invalid
+        ))
+    progress.put(Progress(partition_range.partition, 0, 0, 0, done=True))
+
+
+def worker(
+    ranges: List[PartitionRange],
+    table: str,
+    latest_table: Optional[str],
+    batch_rows: int,
+    stall_timeout: float,
+    progress: multiprocessing.Queue
+) -> None:
+    # Токены дедупликации не используются: повторная загрузка того же
+    # диапазона в пересозданную таблицу не должна отбрасываться
+    transformer = Transformer(
+        settings.clickhouse_insert_mode,
+        False,
+        latest_table
+    )
+    cluster = None
+    if settings.clickhouse_insert_target == 'shards':
+        cluster = settings.clickhouse_cluster
+    consumer = create_consumer()
+    try:
+        with ClickhouseLoader(settings.clickhouse_host,
+                              cluster=cluster) as loader:
+            for partition_range in ranges:
+                load_partition(consumer, transformer, loader, table,
+                               partition_range, batch_rows, progress,
+                               stall_timeout)
+    finally:
+        consumer.close(autocommit=False)
+
+
+def report(
+    ranges: List[PartitionRange],
+    processes: List[multiprocessing.Process],
+    progress: multiprocessing.Queue,
+    interval: float
+) -> Tuple[int, int]:
+    total = sum(r.end - r.start for r in ranges)
+    done_partitions: Set[int] = set()
+    messages = rows = invalid = 0
+    started_at = reported_at = time.monotonic()
+    while len(done_partitions) < len(ranges):
+        try:
+            item: Progress = progress.get(timeout=1)
+        except Empty:
+            if not any(process.is_alive() for process in processes):
+                break
+            continue
+        if item.done:
+            done_partitions.add(item.partition)
+        messages += item.messages
+        rows += item.rows
+        invalid += item.invalid
+        now = time.monotonic()
+        if now - reported_at >= interval:
+            reported_at = now
+            logger.info(
+                'Backfill: %s/%s messages (%.1f%%), %s rows, %s invalid, '
+                '%.0f rows/s, partitions done %s/%s',
+                messages, total, messages / total * 100, rows, invalid,
+                rows / (now - started_at), len(done_partitions), len(ranges)
+            )
+    elapsed = time.monotonic() - started_at
+    logger.info(
+        'Backfill finished: %s messages, %s rows, %s invalid in %.1fs '
+        '(%.0f rows/s)', messages, rows, invalid, elapsed,
+        rows / elapsed if elapsed else 0
+    )
+    return rows, len(done_partitions)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Повторная загрузка диапазона топика в ClickHouse'
+    )
+    parser.add_argument('--from-time', help='ISO-время начала диапазона')
+    parser.add_argument('--to-time', help='ISO-время конца, не включается')
+    parser.add_argument('--from-offset', type=int)
+    parser.add_argument('--to-offset', type=int,
+                        help='офсет конца, не включается')
+    parser.add_argument('--partitions', type=int, nargs='+',
+                        help='по умолчанию все партиции топика')
+    parser.add_argument('--table', default=settings.clickhouse_tablename)
+    parser.add_argument('--latest-table',
+                        default=settings.clickhouse_latest_tablename,
+                        help='пустая строка - не заполнять')
+    parser.add_argument('--batch-rows', type=int, default=100000)
+    parser.add_argument('--stall-timeout', type=float, default=60,
+                        help='сколько секунд ждать сообщений, прежде чем '
+                        'считать партицию недоступной')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--report-interval', type=float, default=5)
+    args = parser.parse_args()
+
+    consumer = create_consumer()
+    try:
+        ranges = resolve_ranges(
+            consumer, settings.kafka_topic, args.partitions,
+            args.from_offset, args.to_offset, args.from_time, args.to_time
+        )
+    finally:
+        consumer.close(autocommit=False)
+    if not ranges:
+        logger.info('Backfill: nothing to load')
+        return
+    for partition_range in ranges:
+        logger.info('Partition %s: offsets [%s, %s)',
+                    partition_range.partition, partition_range.start,
+                    partition_range.end)
+
+    workers_count = min(args.workers, len(ranges))
+    progress: multiprocessing.Queue = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=worker,
+            args=(ranges[worker_id::workers_count], args.table,
+                  args.latest_table or None, args.batch_rows,
+                  args.stall_timeout, progress),
+            name=f'etl-backfill-{worker_id}'
+        )
+        for worker_id in range(workers_count)
+    ]
+    for process in processes:
+        process.start()
+    _, done = report(ranges, processes, progress, args.report_interval)
+    for process in processes:
+        process.join()
+    if done < len(ranges):
+        logger.error('Загружены не все партиции: %s из %s',
+                     done, len(ranges))
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Сравнение декодирования записей Kafka: модель pydantic на каждую запись
+и колоночный батч.
+
+Запуск из каталога src:
+    python -m benchmark.decode --rows 10000 --invalid-ratio 0.01
+"""
+import argparse
+from typing import List
+
+import orjson
+from kafka.consumer.fetcher import ConsumerRecord
+
+from extract.decode import decode_records
+from extract.schema import KafkaData, ViewBatch
+from benchmark.utils import measure_time, view_records
+
+log_template = '''
+Rows per poll: {rows}, invalid ratio: {invalid_ratio}
+Record size: json {json_size:.0f} bytes, binary {binary_size:.0f} bytes
+- pydantic model per record: {pydantic:.6f} s ({pydantic_rps:,.0f} rows/s)
+- columnar batch:            {columnar:.6f} s ({columnar_rps:,.0f} rows/s)
+- columnar batch, binary:    {binary:.6f} s ({binary_rps:,.0f} rows/s)
+'''
+
+
+def decode_with_models(records: List[ConsumerRecord]) -> List[KafkaData]:
+    """Прежний способ: модель на каждую запись, невалидные пропускаются."""
+    payload = []
+    for record in records:
+        try:
+            payload.append(KafkaData(**orjson.loads(record.value)))
+        except Exception:
+            pass
+    return payload
+
+
+def decode_columnar(records: List[ConsumerRecord]) -> ViewBatch:
+    batch = ViewBatch()
+    decode_records(records, batch)
+    return batch
+
+
+def run(rows: int, repeats: int, invalid_ratio: float) -> dict:
+    records = view_records(rows, invalid_ratio)
+    assert len(decode_with_models(records)) == len(decode_columnar(records))
+    binary_records = view_records(rows, invalid_ratio, encoding='binary')
+
+    result = {
+        'rows': rows,
+        'invalid_ratio': invalid_ratio,
+        'pydantic': measure_time(
+            decode_with_models, records, repeats=repeats
+        ),
+        'columnar': measure_time(decode_columnar, records, repeats=repeats),
+        'binary': measure_time(
+            decode_columnar, binary_records, repeats=repeats
+        ),
+        'json_size': sum(len(r.value) for r in records) / rows,
+        'binary_size': sum(len(r.value) for r in binary_records) / rows,
+    }
+    for method in ('pydantic', 'columnar', 'binary'):
+        result[f'{method}_rps'] = rows / result[method]
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--invalid-ratio', type=float, default=0.01)
+    args = parser.parse_args()
+
+    print(log_template.format(
+        **run(args.rows, args.repeats, args.invalid_ratio)
+    ))
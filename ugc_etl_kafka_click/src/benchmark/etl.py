@@ -0,0 +1,194 @@
+"""Замер ETL целиком на заглушках Kafka и ClickHouse.
+
+KafkaExtractor получает FakeConsumer с синтетическими событиями,
+ClickhouseLoader - RecordingClient, который только считает строки.
+
+Запуск из каталога src:
+    python -m benchmark.etl --messages 200000 --partitions 4
+    python -m benchmark.etl --mode sequential --insert-mode sql
+    python -m benchmark.etl --rate 20000 --invalid-ratio 0.05 --latest
+    python -m benchmark.etl --encoding binary
+"""
+import argparse
+import logging
+import os
+import resource
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Callable, Dict
+
+from benchmark.fakes import Exhausted, FakeConsumer, RecordingClient
+
+# Обязательные настройки ETL, если окружение не задано
+ETL_ENVIRONMENT = {
+    'KAFKA_TOPIC': 'views',
+    'KAFKA_SERVER': 'localhost:9092',
+    'KAFKA_GROUPID': 'benchmark',
+    'CLICKHOUSE_HOST': 'localhost',
+    'CLICKHOUSE_TABLENAME': 'default.view',
+    'BACKOFF_MAX_TIME': '1',
+}
+
+log_template = '''
+Messages: {messages} in {partitions} partitions, rate: {rate}, invalid ratio: {invalid_ratio}
+Mode: {mode}, insert mode: {insert_mode}, batch rows: {batch_rows}, encoding: {encoding}
+- total:                {total:.3f} s ({total_rps:,.0f} rows/s)
+- extract (poll+decode): {extract:.3f} s, waiting for data {idle:.3f} s
+- decode:               {decode:.3f} s ({decode_rps:,.0f} rows/s)
+- transform:            {transform:.3f} s ({transform_rps:,.0f} rows/s)
+- load:                 {load:.3f} s ({load_rps:,.0f} rows/s)
+Rows: {rows}, inserted {inserted_rows} rows in {inserts} inserts
+Peak RSS: {peak_rss_mb:.1f} MiB, peak traced: {peak_traced}
+'''
+
+
+class StageTimer:
+    def __init__(self) -> None:
+        self.seconds: Dict[str, float] = defaultdict(float)
+
+    def wrap(self, stage: str, func: Callable) -> Callable:
+        def timed(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.seconds[stage] += time.perf_counter() - started_at
+        return timed
+
+
+def run(args: argparse.Namespace) -> dict:
+    for name, value in ETL_ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+    # Настройки ETL читаются при импорте модулей
+    import extract.base
+    from core.config import settings
+    from extract.base import KafkaExtractor
+    from extract.batching import BatchPolicy
+    from load.base import ClickhouseLoader
+    from pipeline import Pipeline
+    from transform.base import Transformer
+
+    # Лог каждого батча искажает замер
+    logging.getLogger().setLevel(args.log_level)
+    timer = StageTimer()
+    extract.base.decode_records = timer.wrap(
+        'decode', extract.base.decode_records
+    )
+    consumer = FakeConsumer(
+        settings.kafka_topic,
+        args.partitions,
+        args.messages,
+        args.rate,
+        args.invalid_ratio,
+        encoding=args.encoding
+    )
+    client = RecordingClient(args.insert_latency)
+    extractor = KafkaExtractor(
+        settings.kafka_topic,
+        settings.kafka_server,
+        settings.kafka_groupid,
+        BatchPolicy(args.batch_rows, settings.batch_max_bytes,
+                    args.batch_latency),
+        consumer=consumer
+    )
+    extractor._collect_batch = timer.wrap(
+        'extract', extractor._collect_batch
+    )
+    loader = ClickhouseLoader(settings.clickhouse_host, client=client)
+    loader.load = timer.wrap('load', loader.load)
+    transformer = Transformer(
+        args.insert_mode,
+        latest_table='default.view_latest' if args.latest else None
+    )
+    transform_batch = timer.wrap('transform', transformer.transform_batch)
+    rows = 0
+
+    def count_rows(view_batch, table):
+        nonlocal rows
+        rows += len(view_batch)
+        return transform_batch(view_batch, table)
+
+    transformer.transform_batch = count_rows
+    table = settings.clickhouse_tablename
+
+    if args.trace_memory:
+        tracemalloc.start()
+    started_at = time.perf_counter()
+    try:
+        if args.mode == 'pipeline':
+            Pipeline(extractor, transformer, loader, table,
+                     settings.pipeline_queue_size).run()
+        else:
+            for view_batch in extractor.get_updates():
+                if view_batch:
+                    for data in transformer.transform_batch(
+                        view_batch, table
+                    ):
+                        loader.load(data)
+    except Exhausted:
+        pass
+    # Без времени остановки потоков конвейера
+    total = (consumer.finished_at or time.perf_counter()) - started_at
+    peak_traced = 'off'
+    if args.trace_memory:
+        peak_traced = '{0:.1f} MiB'.format(
+            tracemalloc.get_traced_memory()[1] / 2 ** 20
+        )
+        tracemalloc.stop()
+
+    seconds = timer.seconds
+    result = {
+        'messages': args.messages,
+        'partitions': args.partitions,
+        'rate': args.rate or 'unlimited',
+        'invalid_ratio': args.invalid_ratio,
+        'mode': args.mode,
+        'insert_mode': args.insert_mode,
+        'batch_rows': args.batch_rows,
+        'encoding': args.encoding,
+        'total': total,
+        'extract': seconds['extract'] - consumer.idle,
+        'idle': consumer.idle,
+        'decode': seconds['decode'],
+        'transform': seconds['transform'],
+        'load': seconds['load'],
+        'rows': rows,
+        'inserted_rows': client.rows,
+        'inserts': client.inserts,
+        # ru_maxrss в Linux - в килобайтах
+        'peak_rss_mb': resource.getrusage(
+            resource.RUSAGE_SELF
+        ).ru_maxrss / 1024,
+        'peak_traced': peak_traced,
+    }
+    for stage in ('total', 'decode', 'transform', 'load'):
+        result[f'{stage}_rps'] = rows / result[stage] if result[stage] else 0
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--partitions', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='сообщений в секунду, 0 - без ограничения')
+    parser.add_argument('--invalid-ratio', type=float, default=0.01)
+    parser.add_argument('--mode', choices=('pipeline', 'sequential'),
+                        default='pipeline')
+    parser.add_argument('--insert-mode', choices=('columnar', 'sql'),
+                        default='columnar')
+    parser.add_argument('--encoding', choices=('json', 'binary'),
+                        default='json', help='формат сообщений топика')
+    parser.add_argument('--latest', action='store_true',
+                        help='писать также последние позиции')
+    parser.add_argument('--batch-rows', type=int, default=10000)
+    parser.add_argument('--batch-latency', type=float, default=0.5)
+    parser.add_argument('--insert-latency', type=float, default=0,
+                        help='имитация времени вставки, с')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='пик памяти Python через tracemalloc')
+    args = parser.parse_args()
+
+    print(log_template.format(**run(args)))
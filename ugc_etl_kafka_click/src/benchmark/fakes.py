@@ -0,0 +1,183 @@
+"""Заглушки Kafka и ClickHouse для замеров ETL без docker-compose."""
+import time
+from typing import Dict, List, Optional, Set
+
+from kafka.consumer.fetcher import ConsumerRecord
+from kafka.structs import OffsetAndMetadata, TopicPartition
+
+from benchmark.utils import view_records
+
+
+class Exhausted(Exception):
+    """Все сообщения прочитаны."""
+
+
+class FakeConsumer:
+    """Консьюмер с синтетическими событиями в нескольких партициях.
+
+    Значения берутся по кругу из заранее сгенерированного набора.
+    rate ограничивает число сообщений в секунду (0 - без ограничения).
+    Когда все сообщения прочитаны и их офсеты зафиксированы (то есть
+    батчи загружены), poll выбрасывает Exhausted. idle - время, которое
+    poll провел в ожидании, finished_at - время загрузки последнего батча.
+    """
+
+    def __init__(
+        self,
+        topic: str,
+        partitions: int,
+        messages: int,
+        rate: float = 0,
+        invalid_ratio: float = 0,
+        pool_size: int = 10000,
+        encoding: str = 'json'
+    ) -> None:
+        self.topic = topic
+        self.values = [
+            record.value
+            for record in view_records(
+                pool_size, invalid_ratio, topic, encoding=encoding
+            )
+        ]
+        self.partitions = [
+            TopicPartition(topic, partition)
+            for partition in range(partitions)
+        ]
+        self.messages = messages
+        self.rate = rate
+        self.produced = 0
+        self.positions: Dict[TopicPartition, int] = {
+            tp: 0 for tp in self.partitions
+        }
+        self.committed_offsets: Dict[TopicPartition, OffsetAndMetadata] = {}
+        self.paused: Set[TopicPartition] = set()
+        self.started_at: Optional[float] = None
+        self.idle = 0.0
+        self.finished_at: Optional[float] = None
+
+    def poll(self, timeout_ms: int = 0, max_records: int = 500) -> dict:
+        if self.started_at is None:
+            self.started_at = time.perf_counter()
+        available = self.messages - self.produced
+        if self.rate:
+            elapsed = time.perf_counter() - self.started_at
+            available = min(
+                available, int(elapsed * self.rate) - self.produced
+            )
+        active = [tp for tp in self.partitions if tp not in self.paused]
+        if available <= 0 or not active:
+            if self.produced >= self.messages and self._all_committed():
+                self.finished_at = time.perf_counter()
+                raise Exhausted()
+            timeout = timeout_ms / 1000
+            if self.produced >= self.messages:
+                # Ожидание загрузки последних батчей
+                timeout = min(timeout, 0.01)
+            elif self.rate:
+                # Следующее сообщение появится через 1 / rate секунд
+                timeout = min(timeout, 1 / self.rate)
+            time.sleep(timeout)
+            self.idle += timeout
+            return {}
+
+        count = min(available, max_records)
+        response: Dict[TopicPartition, List[ConsumerRecord]] = {}
+        per_partition = -(-count // len(active))
+        values = self.values
+        for tp in active:
+            take = min(per_partition, count)
+            if not take:
+                break
+            offset = self.positions[tp]
+            records = []
+            for position in range(offset, offset + take):
+                value = values[(self.produced + position - offset)
+                               % len(values)]
+                records.append(ConsumerRecord(
+                    tp.topic, tp.partition, position, 0, 0, None, value,
+                    [], None, -1, len(value), -1
+                ))
+            response[tp] = records
+            self.positions[tp] += take
+            self.produced += take
+            count -= take
+        return response
+
+    def _all_committed(self) -> bool:
+        for tp, position in self.positions.items():
+            committed = self.committed_offsets.get(tp)
+            if committed is None or committed.offset < position:
+                return False
+        return True
+
+    def assignment(self) -> Set[TopicPartition]:
+        return set(self.partitions)
+
+    def position(self, tp: TopicPartition) -> int:
+        return self.positions[tp]
+
+    def highwater(self, tp: TopicPartition) -> int:
+        return self.positions[tp]
+
+    def seek(self, tp: TopicPartition, offset: int) -> None:
+        self.positions[tp] = offset
+
+    def pause(self, *partitions: TopicPartition) -> None:
+        self.paused.update(partitions)
+
+    def resume(self, *partitions: TopicPartition) -> None:
+        self.paused.difference_update(partitions)
+
+    def committed(self, tp: TopicPartition, metadata: bool = False):
+        return self.committed_offsets.get(tp)
+
+    def commit(
+        self,
+        offsets: Dict[TopicPartition, OffsetAndMetadata]
+    ) -> None:
+        self.committed_offsets.update(offsets)
+
+    def commit_async(
+        self,
+        offsets: Dict[TopicPartition, OffsetAndMetadata],
+        callback=None
+    ) -> None:
+        self.commit(offsets)
+
+    def close(self, autocommit: bool = True) -> None:
+        pass
+
+
+class FakeConnection:
+    connected = True
+
+    def __init__(self, host: str) -> None:
+        self.host = host
+
+
+class RecordingClient:
+    """Клиент ClickHouse, который только считает вставленные строки.
+
+    insert_latency имитирует время ответа сервера на вставку.
+    """
+
+    def __init__(self, insert_latency: float = 0) -> None:
+        self.connection = FakeConnection('fake')
+        self.insert_latency = insert_latency
+        self.inserts = 0
+        self.rows = 0
+
+    def execute(self, query, params=None, columnar=False, settings=None):
+        if self.insert_latency:
+            time.sleep(self.insert_latency)
+        if not query.startswith('INSERT'):
+            return [(0,)]
+        self.inserts += 1
+        if columnar:
+            self.rows += len(params[0]) if params else 0
+        else:
+            self.rows += query.count('),') or 1
+        return None
+
+    def disconnect(self) -> None:
+        pass
@@ -0,0 +1,68 @@
+"""Сравнение текстового и колоночного режимов вставки в ClickHouse.
+
+Запуск из каталога src:
+    python -m benchmark.insert_modes --rows 10000 --repeats 20
+    python -m benchmark.insert_modes --insert  # + вставка в ClickHouse
+"""
+import argparse
+
+from extract.decode import decode_records
+from extract.schema import ViewBatch
+from transform.base import Transformer
+from benchmark.utils import measure_time, view_records
+
+log_template = '''
+Rows per batch: {rows}
+- sql transform:       {sql_transform:.6f} s ({sql_transform_rps:,.0f} rows/s)
+- columnar transform:  {columnar_transform:.6f} s ({columnar_transform_rps:,.0f} rows/s)
+- sql insert:          {sql_insert}
+- columnar insert:     {columnar_insert}
+'''
+
+
+def run(rows: int, repeats: int, insert: bool) -> dict:
+    table = 'default.view'
+    batch = ViewBatch()
+    decode_records(view_records(rows), batch)
+    sql_transformer = Transformer('sql')
+    columnar_transformer = Transformer('columnar')
+
+    result = {
+        'rows': rows,
+        'sql_transform': measure_time(
+            sql_transformer.transform, batch, table, repeats=repeats
+        ),
+        'columnar_transform': measure_time(
+            columnar_transformer.transform, batch, table, repeats=repeats
+        ),
+        'sql_insert': 'skipped',
+        'columnar_insert': 'skipped',
+    }
+    result['sql_transform_rps'] = rows / result['sql_transform']
+    result['columnar_transform_rps'] = rows / result['columnar_transform']
+
+    if insert:
+        # Настройки ClickHouse читаются из окружения ETL
+        from core.config import settings
+        from load.base import ClickhouseLoader
+
+        table = settings.clickhouse_tablename
+        with ClickhouseLoader(settings.clickhouse_host) as loader:
+            for mode, transformer in (('sql', sql_transformer),
+                                      ('columnar', columnar_transformer)):
+                data = transformer.transform(batch, table)
+                elapsed = measure_time(loader.load, data, repeats=repeats)
+                result[f'{mode}_insert'] = '{0:.6f} s ({1:,.0f} rows/s)'.format(
+                    elapsed, rows / elapsed
+                )
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--insert', action='store_true')
+    args = parser.parse_args()
+
+    print(log_template.format(**run(args.rows, args.repeats, args.insert)))
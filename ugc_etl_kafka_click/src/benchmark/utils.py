@@ -0,0 +1,82 @@
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Iterator, List
+
+import orjson
+from kafka.consumer.fetcher import ConsumerRecord
+
+from extract.decode import HEADER_SIZE, VIEW_SCHEMA_V1, VIEW_V1
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def measure_time(func: Callable, *args, repeats: int = 1, **kwargs) -> float:
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        func(*args, **kwargs)
+    end_time = time.perf_counter()
+    return (end_time - start_time) / repeats
+
+
+def view_events(rows_count: int) -> Iterator[dict]:
+    """Синтетические события просмотра в формате топика views."""
+    films_count = int(rows_count / 1000) or 1
+    film_ids = [str(uuid.uuid4()) for _ in range(films_count)]
+
+    users_count = int(rows_count / 100) or 1
+    user_ids = [str(uuid.uuid4()) for _ in range(users_count)]
+
+    film_length = 60 * 60 * 3
+    now = datetime.utcnow()
+
+    for _ in range(rows_count):
+        start_time = random.randint(0, film_length)
+        timestamp = now - timedelta(seconds=random.randint(0, 86400))
+        yield {
+            'user_id': random.choice(user_ids),
+            'film_id': random.choice(film_ids),
+            'start_time': start_time,
+            'end_time': start_time + 10,
+            'timestamp': timestamp.isoformat(),
+        }
+
+
+def encode_binary(event: dict) -> bytes:
+    """Событие в бинарной схеме 1, как его отправляет сервис."""
+    timestamp = datetime.fromisoformat(event['timestamp'])
+    return bytes((0, VIEW_SCHEMA_V1)) + VIEW_V1.pack(
+        uuid.UUID(event['user_id']).bytes,
+        uuid.UUID(event['film_id']).bytes,
+        event['start_time'],
+        event['end_time'],
+        (timestamp - EPOCH) // timedelta(milliseconds=1)
+    )
+
+
+def view_records(
+    rows_count: int,
+    invalid_ratio: float = 0,
+    topic: str = 'views',
+    partition: int = 0,
+    encoding: str = 'json'
+) -> List[ConsumerRecord]:
+    """Записи Kafka с сырыми байтами событий, часть из них невалидна."""
+    records = []
+    for offset, event in enumerate(view_events(rows_count)):
+        invalid = random.random() < invalid_ratio
+        if encoding == 'binary':
+            value = encode_binary(event)
+            if invalid:
+                # Неизвестная схема
+                value = value[:1] + b'\xff' + value[HEADER_SIZE:]
+        else:
+            if invalid:
+                event['start_time'] = 'invalid'
+            value = orjson.dumps(event)
+        records.append(ConsumerRecord(
+            topic, partition, offset, 0, 0, None, value, [], None,
+            -1, len(value), -1
+        ))
+    return records
@@ -1,5 +1,6 @@
 import os
-from pydantic import BaseSettings
+from typing import Literal, Optional
+from pydantic import BaseSettings, validator
 from logging import getLogger, basicConfig
 
 # Корень проекта
@@ -11,14 +12,82 @@ class Settings(BaseSettings):
     kafka_topic: str
     kafka_server: str
     kafka_groupid: str
+    # Невалидные записи отправляются в этот топик, без него - отбрасываются
+    kafka_dead_letter_topic: Optional[str] = None
+    kafka_dead_letter_chunk_size: int = 500
+    invalid_records_log_interval: float = 60
     clickhouse_host: str
     clickhouse_tablename: str
+    # Таблица последних позиций просмотра, без нее не заполняется
+    clickhouse_latest_tablename: Optional[str] = None
+    # sql - текстовый INSERT ... VALUES, columnar - колоночные блоки
+    # через native-протокол
+    clickhouse_insert_mode: Literal['sql', 'columnar'] = 'columnar'
+    # Вставка блоков с insert_deduplication_token (ClickHouse 22.2+),
+    # повторная загрузка батча после сбоя не создает дубликатов
+    clickhouse_insert_dedup: bool = False
+    # distributed - вставка в Distributed-таблицу, shards - напрямую в
+    # локальные таблицы шардов кластера clickhouse_cluster (только columnar)
+    clickhouse_insert_target: Literal['distributed', 'shards'] = 'distributed'
+    clickhouse_cluster: str = 'company_cluster'
     backoff_max_time: float
-    sleep_interval: int
+    # Нагрузка на ClickHouse: при времени вставки больше целевого или
+    # числе кусков в партиции больше мягкого лимита батчи укрупняются
+    # (до batch_max_scale раз), при жестком лимите или ошибке
+    # TOO_MANY_PARTS чтение из Kafka ставится на паузу
+    clickhouse_latency_target: float = 2.0
+    clickhouse_parts_soft_limit: int = 150
+    clickhouse_parts_hard_limit: int = 250
+    clickhouse_parts_check_interval: float = 10
+    clickhouse_pressure_pause: float = 10
+    # Предел повторов вставки, отклоненной с TOO_MANY_PARTS. Должен быть
+    # меньше max.poll.interval.ms консьюмера (300 с): в последовательном
+    # режиме Kafka не опрашивается, пока вставка повторяется
+    clickhouse_too_many_parts_max_time: float = 120
+    batch_max_scale: float = 8
+    # Каталог спула: при недоступности ClickHouse батчи сохраняются
+    # на диск, офсеты фиксируются, батчи загружаются после восстановления.
+    # Без него загрузчик повторяет вставку до backoff_max_time
+    spool_dir: Optional[str] = None
+    spool_segment_max_bytes: int = 64 * 1024 * 1024
+    spool_retry_interval: float = 10
+    spool_replay_max_rows: int = 200000
+    # Батч сбрасывается при достижении любого из лимитов
+    batch_max_rows: int = 10000
+    batch_max_bytes: int = 16 * 1024 * 1024
+    batch_max_latency: float = 5.0
+    # sequential - стадии ETL выполняются по очереди в одном потоке,
+    # pipeline - в отдельных потоках, связанных очередями
+    etl_mode: Literal['sequential', 'pipeline'] = 'pipeline'
+    pipeline_queue_size: int = 2
+    # Сколько ждать загрузки батчей в работе при ребалансировке
+    # и остановке
+    rebalance_flush_timeout: float = 30
+    # Число процессов-воркеров супервизора, 0 - по числу ядер
+    etl_workers: int = 1
+    supervisor_report_interval: float = 30
+    supervisor_max_restart_delay: float = 60
+    # Воркер с номером N отдает метрики на порту metrics_port + N
+    metrics_port: int = 8001
 
     class Config:
         env_file = ENV_FILE_PATH
 
+    @validator('clickhouse_insert_dedup')
+    def dedup_requires_columnar(cls, value, values):
+        if value and values.get('clickhouse_insert_mode') != 'columnar':
+            raise ValueError('dedup is supported in columnar insert mode only')
+        return value
+
+    @validator('clickhouse_insert_target')
+    def shards_require_columnar(cls, value, values):
+        if value == 'shards' and \
+                values.get('clickhouse_insert_mode') != 'columnar':
+            raise ValueError(
+                'shard writes are supported in columnar insert mode only'
+            )
+        return value
+
 
 settings = Settings()
 
@@ -0,0 +1,108 @@
+from backoff.types import Details
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+
+BATCH_ROWS_BUCKETS = (100, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+BATCH_FILL_LEVEL = Gauge(
+    'etl_batch_fill_level',
+    'Fill level of the batch being accumulated, share of the closest limit'
+)
+BATCH_ROWS = Histogram(
+    'etl_batch_rows',
+    'Valid rows per flushed batch',
+    buckets=BATCH_ROWS_BUCKETS
+)
+BATCH_BYTES = Histogram(
+    'etl_batch_bytes',
+    'Kafka message bytes per flushed batch',
+    buckets=tuple(rows * 200 for rows in BATCH_ROWS_BUCKETS)
+)
+BATCH_FLUSHES = Counter(
+    'etl_batch_flushes',
+    'Flushed batches by the limit that triggered the flush',
+    ['reason']
+)
+
+ROWS_CONSUMED = Counter(
+    'etl_rows_consumed',
+    'Valid rows read from Kafka'
+)
+ROWS_LOADED = Counter(
+    'etl_rows_loaded',
+    'Rows inserted into ClickHouse',
+    ['table']
+)
+CONSUMER_LAG = Gauge(
+    'etl_consumer_lag',
+    'Messages between the consumer position and the partition highwater',
+    ['topic', 'partition']
+)
+INSERT_LATENCY = Histogram(
+    'etl_insert_latency_seconds',
+    'ClickHouse insert latency per batch, retries included',
+    buckets=LATENCY_BUCKETS
+)
+COMMIT_LATENCY = Histogram(
+    'etl_commit_latency_seconds',
+    'Kafka offset commit latency',
+    buckets=LATENCY_BUCKETS
+)
+
+CLICKHOUSE_ACTIVE_PARTS = Gauge(
+    'etl_clickhouse_active_parts',
+    'Max active parts per partition of the target table'
+)
+BATCH_SCALE = Gauge(
+    'etl_batch_scale',
+    'Multiplier applied to batch limits under ClickHouse load'
+)
+THROTTLED_PARTITIONS = Gauge(
+    'etl_throttled_partitions',
+    'Kafka partitions paused because of ClickHouse load'
+)
+
+SPOOL_BYTES = Gauge(
+    'etl_spool_bytes',
+    'Size of spool segments waiting to be loaded into ClickHouse'
+)
+SPOOLED_ROWS = Counter(
+    'etl_spooled_rows',
+    'Rows written to the disk spool while ClickHouse was unavailable'
+)
+SPOOL_REPLAYED_ROWS = Counter(
+    'etl_spool_replayed_rows',
+    'Rows loaded into ClickHouse from the disk spool'
+)
+SPOOL_QUARANTINED_SEGMENTS = Counter(
+    'etl_spool_quarantined_segments',
+    'Spool segments set aside after ClickHouse rejected their data'
+)
+
+INVALID_RECORDS = Counter(
+    'etl_invalid_records',
+    'Records skipped because of invalid format, by the first invalid field',
+    ['field']
+)
+DEAD_LETTER_RECORDS = Counter(
+    'etl_dead_letter_records',
+    'Invalid records produced to the dead-letter topic'
+)
+BACKOFF_RETRIES = Counter(
+    'etl_backoff_retries',
+    'Retries made by backoff decorators',
+    ['target']
+)
+
+
+def count_backoff(details: Details) -> None:
+    """Обработчик on_backoff для декораторов backoff."""
+    BACKOFF_RETRIES.labels(target=details['target'].__qualname__).inc()
+
+
+BATCH_SCALE.set(1)
+
+
+def start_metrics_server(port: int) -> None:
+    start_http_server(port)
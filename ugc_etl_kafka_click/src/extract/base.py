@@ -1,21 +1,88 @@
+import threading
 from logging import getLogger
-from typing import Generator, Optional
-from kafka import KafkaConsumer, errors
-from .schema import KafkaData, KafkaBulkData
+from queue import Empty, SimpleQueue
+from time import monotonic, sleep
+from typing import Callable, Dict, Generator, List, Optional, Set
+from kafka import ConsumerRebalanceListener, KafkaConsumer, errors
+from kafka.consumer.fetcher import ConsumerRecord
+from kafka.structs import TopicPartition
+from .batching import BatchPolicy
+from .dead_letter import DeadLetterQueue
+from .decode import decode_records
+from .offsets import OffsetTracker
+from .schema import ViewBatch, ViewBlock
+from core import metrics
 from core.config import settings
-import orjson
+from load.pressure import LoadPressure
 import backoff
 
 
 logger = getLogger(__name__)
 
 
+class FlushOnRevoke(ConsumerRebalanceListener):
+    """Перед передачей партиций другому консьюмеру группы загружает
+    батчи в работе и фиксирует их офсеты."""
+
+    def __init__(self, extractor: 'KafkaExtractor') -> None:
+        self.extractor = extractor
+
+    def on_partitions_revoked(self, revoked) -> None:
+        self.extractor.release(set(revoked))
+
+    def on_partitions_assigned(self, assigned) -> None:
+        logger.info('Partitions assigned: %s', ', '.join(
+            f'{tp.topic}-{tp.partition}' for tp in sorted(assigned)
+        ))
+
+
 class KafkaExtractor:
-    def __init__(self, topic: str, server: str, group_id: str) -> None:
+    # Флаги остановки и нагрузки на ClickHouse проверяются между poll
+    POLL_INTERVAL_MS = 1000
+
+    def __init__(
+        self,
+        topic: str,
+        server: str,
+        group_id: str,
+        batch_policy: Optional[BatchPolicy] = None,
+        fence_offsets: Optional[bool] = None,
+        pressure: Optional[LoadPressure] = None,
+        consumer: Optional[KafkaConsumer] = None
+    ) -> None:
+        """consumer - готовый консьюмер вместо создаваемого при первом
+        обращении, например заглушка в бенчмарке."""
         self.topic = topic
         self.server = server
         self.group_id = group_id
-        self._consumer = None
+        self.batch_policy = batch_policy or BatchPolicy(
+            settings.batch_max_rows,
+            settings.batch_max_bytes,
+            settings.batch_max_latency
+        )
+        # Диапазоны батчей фиксируются в Kafka до загрузки, чтобы после
+        # сбоя повторить их точно и дать ClickHouse отбросить дубликаты
+        if fence_offsets is None:
+            fence_offsets = settings.clickhouse_insert_dedup
+        self.fence_offsets = fence_offsets
+        # Нагрузка на ClickHouse по замерам загрузчика
+        self.pressure = pressure
+        self._throttled: Set[TopicPartition] = set()
+        self.offsets = OffsetTracker()
+        self.dead_letter = DeadLetterQueue(
+            settings.kafka_dead_letter_topic,
+            server,
+            settings.kafka_dead_letter_chunk_size,
+            settings.invalid_records_log_interval
+        )
+        self._consumer = consumer
+        self._acknowledged: SimpleQueue = SimpleQueue()
+        self._lag_partitions: Set[TopicPartition] = set()
+        # Загрузка недособранного батча при отзыве партиций, вызывается
+        # в потоке чтения, когда остальные батчи уже загружены
+        self.flush_handler: Optional[Callable[[ViewBatch], None]] = None
+        self._stopping = threading.Event()
+        self._start_batch()
 
     def __enter__(self):
         return self
@@ -24,6 +91,7 @@ class KafkaExtractor:
         try:
             if self._consumer:
                 self._consumer.close(autocommit=False)
+            self.dead_letter.close()
         except Exception:
             logger.exception(
                 'Возникла ошибка при закрытии соединения Kafka, server=%s',
@@ -33,40 +101,350 @@ class KafkaExtractor:
     @property
     @backoff.on_exception(backoff.expo,
                           (errors.NoBrokersAvailable, ConnectionRefusedError),
-                          max_time=settings.backoff_max_time)
+                          max_time=settings.backoff_max_time,
+                          on_backoff=metrics.count_backoff)
     def consumer(self) -> KafkaConsumer:
         if not self._consumer:
-            self._consumer = KafkaConsumer(
-                self.topic,
+            consumer = KafkaConsumer(
                 bootstrap_servers=[self.server],
                 auto_offset_reset='earliest',
                 group_id=self.group_id,
-                value_deserializer=orjson.loads,
                 enable_auto_commit=False,
                 consumer_timeout_ms=1000
             )
+            consumer.subscribe(
+                topics=[self.topic],
+                listener=FlushOnRevoke(self)
+            )
+            self._consumer = consumer
         return self._consumer
 
+    def assigned_partitions(self) -> Set[TopicPartition]:
+        if not self._consumer:
+            return set()
+        return self._consumer.assignment()
+
     @backoff.on_exception(backoff.expo,
                           (errors.NoBrokersAvailable, ConnectionRefusedError),
-                          max_time=settings.backoff_max_time)
-    def get_updates(self) -> Generator[Optional[KafkaBulkData], None, None]:
+                          max_time=settings.backoff_max_time,
+                          on_backoff=metrics.count_backoff)
+    def get_updates(
+        self,
+        commit: bool = True
+    ) -> Generator[ViewBatch, None, None]:
+        """При commit=False офсеты фиксируются только после вызова
+        acknowledge для загруженного батча.
+
+        После stop() отдает недособранный батч и завершается.
+        """
+        while not self._stopping.is_set():
+            batch = self._collect_batch()
+            yield batch
+            if commit:
+                self.acknowledge(batch.blocks)
+                # Асинхронный коммит может не уйти до закрытия консьюмера
+                self.commit_acknowledged(sync=self._stopping.is_set())
+
+    def stop(self) -> None:
+        """Можно вызывать из обработчика сигнала."""
+        self._stopping.set()
+
+    def release(self, revoked: Set[TopicPartition]) -> None:
+        """Вызывается из poll перед отзывом партиций: дожидается
+        загрузки выданных батчей, загружает недособранный через
+        flush_handler и синхронно фиксирует офсеты."""
+        if not revoked:
+            return
+        self.wait_acknowledged()
+        if self._parts:
+            if self.flush_handler and not self.offsets.has_pending():
+                batch = self._finish_batch('rebalance')
+                self.flush_handler(batch)
+                self.acknowledge(batch.blocks)
+            else:
+                logger.warning(
+                    'Недособранный батч из %s строк отброшен при '
+                    'ребалансировке, записи будут перечитаны',
+                    self.batch_policy.rows
+                )
+                self._drop_batch()
+        self.commit_acknowledged(sync=True)
+        for partition in revoked:
+            self.offsets.forget(partition)
+        self._throttled -= revoked
+        logger.info('Partitions released: %s', ', '.join(
+            f'{tp.topic}-{tp.partition}' for tp in sorted(revoked)
+        ))
+
+    def wait_acknowledged(
+        self,
+        timeout: Optional[float] = None,
+        abort: Optional[threading.Event] = None
+    ) -> bool:
+        """Ждет подтверждения загрузки всех выданных батчей и фиксирует
+        их офсеты. Возвращает False, если не дождался за timeout
+        или ожидание прервано через abort."""
+        if timeout is None:
+            timeout = settings.rebalance_flush_timeout
+        deadline = monotonic() + timeout
+        while True:
+            self.commit_acknowledged(sync=True)
+            if not self.offsets.has_pending():
+                return True
+            if abort and abort.is_set():
+                return False
+            if monotonic() >= deadline:
+                logger.warning(
+                    'Не все батчи загружены за %ss, их записи будут '
+                    'перечитаны', timeout
+                )
+                return False
+            sleep(0.05)
+
+    def acknowledge(self, blocks: List[ViewBlock]) -> None:
+        """Потокобезопасно: офсеты будут зафиксированы потоком,
+        который читает из Kafka."""
+        self._acknowledged.put(blocks)
+
+    def commit_acknowledged(self, sync: bool = False) -> None:
+        blocks: List[ViewBlock] = []
+        while True:
+            try:
+                blocks.extend(self._acknowledged.get_nowait())
+            except Empty:
+                break
+        if not blocks:
+            return
+        offsets = self.offsets.acknowledge(blocks)
+        # Подтверждения могут прийти после отзыва партиции
+        assigned = self.consumer.assignment()
+        offsets = {
+            partition: offset for partition, offset in offsets.items()
+            if partition in assigned
+        }
+        if not offsets:
+            return
+        if self.fence_offsets and not sync:
+            # Повтор уже загруженного батча отбросит ClickHouse,
+            # поэтому ждать подтверждения коммита не нужно
+            self.consumer.commit_async(offsets)
+        else:
+            with metrics.COMMIT_LATENCY.time():
+                self.consumer.commit(offsets)
+
+    def _collect_batch(self) -> ViewBatch:
+        """Накапливает записи из нескольких poll, пока не сработает
+        один из лимитов батча.
+
+        Записи каждой партиции образуют отдельный блок батча.
+        """
+        policy = self.batch_policy
+        self._start_batch()
         while True:
-            result = KafkaBulkData(payload=[])
+            self.commit_acknowledged()
+            self._throttle(self._paused)
+            # Отзыв партиций внутри poll может сбросить накопленный батч
             response = self.consumer.poll(
-                timeout_ms=1000,
-                max_records=10000
+                timeout_ms=min(policy.poll_timeout_ms(),
+                               self.POLL_INTERVAL_MS),
+                max_records=policy.rows_left
             )
-            for records in response.values():
-                for record in records:
-                    try:
-                        kafka_data = KafkaData(**record.value)
-                    except Exception:
-                        logger.warning(
-                            'Пропуск записи %s. Неверный формат',
-                            record.value
-                        )
-                    else:
-                        result.payload.append(kafka_data)
-            yield result
-            self.consumer.commit()
+            parts = self._parts
+            ranges = self._ranges
+            for partition, records in response.items():
+                records = self._limit_replay(
+                    partition, records, ranges, self._paused
+                )
+                if not records:
+                    continue
+                if partition not in parts:
+                    parts[partition] = ViewBatch()
+                    ranges[partition] = [records[0].offset, 0]
+                ranges[partition][1] = records[-1].offset
+
+                part = parts[partition]
+                rows = len(part)
+                self.dead_letter.add(partition, decode_records(records, part))
+                policy.add(
+                    sum(record.serialized_value_size for record in records),
+                    rows=len(part) - rows
+                )
+            metrics.BATCH_FILL_LEVEL.set(policy.fill_level)
+
+            if self._stopping.is_set():
+                return self._finish_batch('shutdown')
+            reason = policy.flush_reason()
+            if reason and self._replay_complete(
+                ranges, self._paused, policy.age
+            ):
+                return self._finish_batch(reason)
+
+    def _start_batch(self) -> None:
+        if self.pressure:
+            self.batch_policy.set_scale(self.pressure.batch_scale)
+        self.batch_policy.reset()
+        self._parts: Dict[TopicPartition, ViewBatch] = {}
+        self._ranges: Dict[TopicPartition, List[int]] = {}
+        self._paused: List[TopicPartition] = []
+
+    def _drop_batch(self) -> None:
+        self._resume_paused()
+        self.dead_letter.discard()
+        self._start_batch()
+
+    def _resume_paused(self) -> None:
+        assigned = self.consumer.assignment()
+        resume = [
+            partition for partition in self._paused
+            if partition not in self._throttled and partition in assigned
+        ]
+        if resume:
+            self.consumer.resume(*resume)
+
+    def _finish_batch(self, reason: str) -> ViewBatch:
+        policy = self.batch_policy
+        self._resume_paused()
+        result = self._assemble(self._parts, self._ranges)
+        self.dead_letter.flush()
+        self.offsets.add(result.blocks)
+        if self.fence_offsets:
+            # commit_async отправляет запрос сразу, и он доходит до брокера
+            # раньше, чем заканчивается загрузка батча. Если коммит все же
+            # потерян, после сбоя батч нарежется по прежним диапазонам и
+            # повтор уже загруженных строк не будет отброшен
+            self.consumer.commit_async(
+                self.offsets.fence(result.blocks),
+                callback=self._fence_committed
+            )
+
+        logger.info(
+            'Batch ready: %s rows, %s bytes, fill %.0f%%, age %.2fs, reason=%s',
+            policy.rows, policy.size, policy.fill_level * 100, policy.age,
+            reason
+        )
+        metrics.BATCH_ROWS.observe(policy.rows)
+        metrics.BATCH_BYTES.observe(policy.size)
+        metrics.BATCH_FLUSHES.labels(reason=reason).inc()
+        metrics.ROWS_CONSUMED.inc(policy.rows)
+        self._report_lag()
+        self._start_batch()
+        return result
+
+    @staticmethod
+    def _fence_committed(offsets, response) -> None:
+        if isinstance(response, Exception):
+            logger.warning(
+                'Не удалось зафиксировать диапазоны батча %s: %s',
+                offsets, response
+            )
+
+    def _report_lag(self) -> None:
+        """Отставание считается по highwater из последнего fetch,
+        поэтому не требует дополнительных запросов к брокеру."""
+        assigned = self.consumer.assignment()
+        for partition in self._lag_partitions - assigned:
+            metrics.CONSUMER_LAG.remove(
+                partition.topic, str(partition.partition)
+            )
+        for partition in assigned:
+            highwater = self.consumer.highwater(partition)
+            if highwater is None:
+                continue
+            metrics.CONSUMER_LAG.labels(
+                partition.topic, str(partition.partition)
+            ).set(max(highwater - self.consumer.position(partition), 0))
+        self._lag_partitions = set(assigned)
+
+    def _throttle(self, paused: List[TopicPartition]) -> None:
+        """Пока ClickHouse перегружен, партиции стоят на паузе, но poll
+        продолжает вызываться, чтобы консьюмер оставался в группе."""
+        if not self.pressure:
+            return
+        assigned = self.consumer.assignment()
+        if self.pressure.paused:
+            throttle = assigned - self._throttled
+            if throttle:
+                self.consumer.pause(*throttle)
+                self._throttled |= throttle
+        elif self._throttled:
+            # Партиции, отданные при ребалансировке, возобновлять нельзя
+            resume = (self._throttled & assigned).difference(paused)
+            if resume:
+                self.consumer.resume(*resume)
+            self._throttled = set()
+            logger.info('Kafka partitions resumed after ClickHouse load')
+        metrics.THROTTLED_PARTITIONS.set(len(self._throttled))
+
+    def _limit_replay(
+        self,
+        partition: TopicPartition,
+        records: List[ConsumerRecord],
+        ranges: Dict[TopicPartition, List[int]],
+        paused: List[TopicPartition]
+    ) -> List[ConsumerRecord]:
+        """Обрезает записи партиции по диапазону, который был в работе
+        до перезапуска. Остаток будет перечитан в следующем батче."""
+        if not self.offsets.knows(partition):
+            committed = None
+            if self.fence_offsets:
+                committed = self.consumer.committed(partition, metadata=True)
+            self.offsets.restore(partition, committed)
+
+        replay_range = self.offsets.replay_range(partition)
+        if not replay_range:
+            return records
+        first, last = replay_range
+        block_first = ranges[partition][0] if partition in ranges \
+            else records[0].offset
+        if block_first != first:
+            self.offsets.drop_replay(partition)
+            return records
+        if records[-1].offset < last:
+            return records
+
+        self.offsets.replay_done(partition)
+        self.consumer.seek(partition, last + 1)
+        self.consumer.pause(partition)
+        paused.append(partition)
+        return [record for record in records if record.offset <= last]
+
+    def _replay_complete(
+        self,
+        ranges: Dict[TopicPartition, List[int]],
+        paused: List[TopicPartition],
+        age: float
+    ) -> bool:
+        """Блок, повторяющий диапазон до перезапуска, нельзя сбросить
+        раньше, чем он дочитан до конца."""
+        active = [
+            partition for partition in ranges if partition not in paused
+        ]
+        incomplete = [
+            partition for partition in active
+            if self.offsets.replay_range(partition)
+        ]
+        if not incomplete:
+            return True
+        if age < self.batch_policy.max_latency * 10:
+            return False
+        for partition in incomplete:
+            self.offsets.drop_replay(partition)
+        return True
+
+    @staticmethod
+    def _assemble(
+        parts: Dict[TopicPartition, ViewBatch],
+        ranges: Dict[TopicPartition, List[int]]
+    ) -> ViewBatch:
+        result = ViewBatch()
+        for partition, part in parts.items():
+            first, last = ranges[partition]
+            if not result.blocks:
+                # Колонки первой партиции используются без копирования
+                result = part
+                result.blocks.append(
+                    ViewBlock(partition, first, last, 0, len(part))
+                )
+            else:
+                result.extend(part, partition, first, last)
+        return result
@@ -0,0 +1,67 @@
+from time import monotonic
+from typing import Optional
+
+
+class BatchPolicy:
+    """Границы батча: число строк, объем в байтах и задержка.
+
+    Задержка отсчитывается от первой записи батча, поэтому при отсутствии
+    данных пустые батчи не формируются.
+    """
+
+    def __init__(
+        self,
+        max_rows: int,
+        max_bytes: int,
+        max_latency: float
+    ) -> None:
+        self._limits = (max_rows, max_bytes, max_latency)
+        self.set_scale(1)
+        self.reset()
+
+    def set_scale(self, scale: float) -> None:
+        """Увеличивает лимиты в scale раз относительно заданных."""
+        max_rows, max_bytes, max_latency = self._limits
+        self.scale = scale
+        self.max_rows = int(max_rows * scale)
+        self.max_bytes = int(max_bytes * scale)
+        self.max_latency = max_latency * scale
+
+    def reset(self) -> None:
+        self.rows = 0
+        self.size = 0
+        self.started_at: Optional[float] = None
+
+    def add(self, size: int, rows: int = 1) -> None:
+        if self.started_at is None:
+            self.started_at = monotonic()
+        self.rows += rows
+        self.size += size
+
+    @property
+    def age(self) -> float:
+        if self.started_at is None:
+            return 0
+        return monotonic() - self.started_at
+
+    @property
+    def fill_level(self) -> float:
+        return max(self.rows / self.max_rows, self.size / self.max_bytes)
+
+    @property
+    def rows_left(self) -> int:
+        return max(self.max_rows - self.rows, 1)
+
+    def poll_timeout_ms(self) -> int:
+        if self.started_at is None:
+            return int(self.max_latency * 1000)
+        return max(int((self.max_latency - self.age) * 1000), 0)
+
+    def flush_reason(self) -> Optional[str]:
+        if self.rows >= self.max_rows:
+            return 'rows'
+        if self.size >= self.max_bytes:
+            return 'bytes'
+        if self.started_at is not None and self.age >= self.max_latency:
+            return 'latency'
+        return None
@@ -0,0 +1,162 @@
+import base64
+from logging import getLogger
+from time import monotonic
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import backoff
+import orjson
+from kafka import KafkaProducer, errors
+from kafka.consumer.fetcher import ConsumerRecord
+from kafka.structs import TopicPartition
+
+from core import metrics
+from core.config import settings
+from .decode import InvalidRecord
+
+
+logger = getLogger(__name__)
+
+# max_request_size продюсера. Сообщение собирается из записей, пока
+# не превысит предел за вычетом запаса на обертку и заголовки батча
+MAX_REQUEST_SIZE = 1024 * 1024
+MAX_RECORDS_SIZE = MAX_REQUEST_SIZE - 4096
+# Значение записи больше этого обрезается, чтобы запись поместилась
+# в сообщение вместе с офсетом и текстом ошибки
+MAX_VALUE_SIZE = MAX_RECORDS_SIZE - 4096
+
+
+class DeadLetterQueue:
+    """Невалидные записи батча, сгруппированные по партициям.
+
+    Записи одной партиции уходят в топик невалидных сообщений одним
+    сообщением: исходный офсет, причина ошибки и исходные байты в base64.
+    Если записей много, сообщений несколько: не больше chunk_size записей
+    и MAX_RECORDS_SIZE байт в каждом.
+    Вместо записи в лог на каждую запись - счетчики и сводка в логе не
+    чаще раза в log_interval секунд.
+    """
+
+    def __init__(
+        self,
+        topic: Optional[str],
+        server: str,
+        chunk_size: int,
+        log_interval: float
+    ) -> None:
+        self.topic = topic
+        self.server = server
+        self.chunk_size = chunk_size
+        self.log_interval = log_interval
+        self._records: Dict[TopicPartition, List[dict]] = {}
+        self._producer: Optional[KafkaProducer] = None
+        self._skipped = 0
+        self._last_error: Optional[Tuple[ConsumerRecord, InvalidRecord]] = None
+        self._logged_at = monotonic()
+
+    @property
+    @backoff.on_exception(backoff.expo,
+                          (errors.NoBrokersAvailable, ConnectionRefusedError),
+                          max_time=settings.backoff_max_time,
+                          on_backoff=metrics.count_backoff)
+    def producer(self) -> KafkaProducer:
+        if not self._producer:
+            self._producer = KafkaProducer(
+                bootstrap_servers=[self.server],
+                linger_ms=100,
+                max_request_size=MAX_REQUEST_SIZE
+            )
+        return self._producer
+
+    def close(self) -> None:
+        if self._producer:
+            self._producer.close()
+
+    def add(
+        self,
+        partition: TopicPartition,
+        invalid: List[Tuple[ConsumerRecord, InvalidRecord]]
+    ) -> None:
+        if not invalid:
+            return
+        for record, error in invalid:
+            metrics.INVALID_RECORDS.labels(field=error.field).inc()
+        self._skipped += len(invalid)
+        self._last_error = invalid[-1]
+        if not self.topic:
+            return
+        self._records.setdefault(partition, []).extend(
+            self._dead_letter(record, error) for record, error in invalid
+        )
+
+    def discard(self) -> None:
+        """Забывает записи батча, который отброшен и будет перечитан:
+        при повторном чтении они добавятся снова."""
+        self._records = {}
+
+    @staticmethod
+    def _dead_letter(record: ConsumerRecord, error: InvalidRecord) -> dict:
+        value = base64.b64encode(record.value or b'').decode()
+        result = {'offset': record.offset, 'error': str(error)[:500]}
+        if len(value) > MAX_VALUE_SIZE:
+            result['truncated'] = True
+            value = value[:MAX_VALUE_SIZE]
+        result['value'] = value
+        return result
+
+    def flush(self) -> None:
+        """Отправляет накопленные записи и дожидается подтверждения,
+        после этого офсеты батча можно фиксировать. Если отправка не
+        удалась, выбрасывает исключение KafkaError."""
+        self._log_skipped()
+        if not self._records:
+            return
+        sent = []
+        for partition, records in self._records.items():
+            for chunk in self._chunks(records):
+                future = self.producer.send(
+                    self.topic,
+                    key=f'{partition.topic}-{partition.partition}'.encode(),
+                    value=orjson.dumps({
+                        'topic': partition.topic,
+                        'partition': partition.partition,
+                        'records': chunk,
+                    })
+                )
+                sent.append((future, len(chunk)))
+        # flush не сообщает об ошибках доставки, они - в результатах send
+        self.producer.flush()
+        for future, count in sent:
+            future.get()
+            metrics.DEAD_LETTER_RECORDS.inc(count)
+        self._records = {}
+
+    def _chunks(self, records: List[dict]) -> Iterator[List[dict]]:
+        chunk: List[dict] = []
+        size = 0
+        for record in records:
+            record_size = len(orjson.dumps(record)) + 1
+            full = len(chunk) >= self.chunk_size
+            oversized = size + record_size > MAX_RECORDS_SIZE
+            if chunk and (full or oversized):
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(record)
+            size += record_size
+        if chunk:
+            yield chunk
+
+    def _log_skipped(self) -> None:
+        if not self._skipped or monotonic() - self._logged_at < self.log_interval:
+            return
+        if self._last_error is None:
+            return
+        record, error = self._last_error
+        logger.warning(
+            'Пропущено %s записей с неверным форматом за %.0f с. '
+            'Последняя: %s-%s@%s, ошибка: %s',
+            self._skipped, monotonic() - self._logged_at,
+            record.topic, record.partition, record.offset, error
+        )
+        self._skipped = 0
+        self._logged_at = monotonic()
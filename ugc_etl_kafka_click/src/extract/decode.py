@@ -0,0 +1,154 @@
+import re
+import struct
+from datetime import datetime
+from typing import Any, Iterable, List, Tuple
+from uuid import UUID
+
+import orjson
+from kafka.consumer.fetcher import ConsumerRecord
+from pydantic.datetime_parse import parse_datetime
+
+from .schema import ViewBatch
+
+
+UUID_RE = re.compile(
+    r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
+)
+
+
+# Бинарные сообщения начинаются с нулевого байта (JSON так начинаться
+# не может) и номера схемы. Схема 1: user_id и film_id - 16 байт UUID,
+# start_time и end_time - int32, время события - int64, миллисекунды
+# от эпохи по времени без часового пояса, как его сохраняет ETL из JSON
+BINARY_MAGIC = 0
+VIEW_SCHEMA_V1 = 1
+HEADER_SIZE = 2
+VIEW_V1 = struct.Struct('<16s16siiq')
+SUPPORTED_SCHEMAS = (VIEW_SCHEMA_V1,)
+
+# start_time и end_time в таблице - UInt16. Колоночная вставка падает
+# на значении вне диапазона, поэтому такие записи считаются невалидными
+POSITION_MAX = 0xFFFF
+
+
+class InvalidRecord(ValueError):
+    def __init__(self, field: str, error: Exception) -> None:
+        super().__init__(f'{field}: {type(error).__name__}: {error}')
+        self.field = field
+
+
+# Функции повторяют валидаторы pydantic для полей KafkaData, но не
+# требуют создания модели на каждую запись
+
+
+def decode_uuid(value: Any) -> str:
+    if type(value) is str and UUID_RE.fullmatch(value):
+        return value
+    return str(UUID(value))
+
+
+def format_uuid(value: bytes) -> str:
+    # В несколько раз быстрее str(UUID(bytes=value))
+    hex_value = value.hex()
+    return (
+        f'{hex_value[:8]}-{hex_value[8:12]}-{hex_value[12:16]}-'
+        f'{hex_value[16:20]}-{hex_value[20:]}'
+    )
+
+
+def check_position(value: int) -> int:
+    if not 0 <= value <= POSITION_MAX:
+        raise ValueError(f'{value} is out of range 0..{POSITION_MAX}')
+    return value
+
+
+def decode_datetime(value: Any) -> datetime:
+    # fromisoformat быстрее parse_datetime, но принимает больше форматов,
+    # поэтому используется только для строк вида YYYY-MM-DD[T ]HH:MM...
+    if type(value) is str and len(value) >= 16 and ',' not in value:
+        if value[10] in 'T ' and value[13] == ':':
+            try:
+                return datetime.fromisoformat(value)
+            except ValueError:
+                pass
+    return parse_datetime(value)
+
+
+def decode_records(
+    records: Iterable[ConsumerRecord],
+    batch: ViewBatch
+) -> List[Tuple[ConsumerRecord, InvalidRecord]]:
+    """Декодирует записи poll в колонки батча.
+
+    Принимает и бинарные сообщения, и JSON. Записи, которые не прошли бы
+    валидацию KafkaData, записи с позицией вне диапазона UInt16 и записи
+    неизвестной схемы пропускаются и возвращаются вместе с ошибкой.
+    """
+    loads = orjson.loads
+    unpack_v1 = VIEW_V1.unpack_from
+    binary_size = HEADER_SIZE + VIEW_V1.size
+    from_timestamp = datetime.utcfromtimestamp
+    user_ids = batch.user_id
+    film_ids = batch.film_id
+    start_times = batch.start_time
+    end_times = batch.end_time
+    event_times = batch.event_time
+    invalid = []
+
+    for record in records:
+        raw = record.value
+        # Сообщение-tombstone без значения
+        if raw is None:
+            invalid.append(
+                (record, InvalidRecord('value', ValueError('no value')))
+            )
+            continue
+        if raw[:1] == b'\x00':
+            field = 'schema'
+            try:
+                if raw[1] not in SUPPORTED_SCHEMAS:
+                    raise ValueError(f'unknown schema id {raw[1]}')
+                if len(raw) != binary_size:
+                    raise ValueError(f'unexpected size {len(raw)}')
+                user_id, film_id, start_time, end_time, event_ms = \
+                    unpack_v1(raw, HEADER_SIZE)
+                field = 'start_time'
+                check_position(start_time)
+                field = 'end_time'
+                check_position(end_time)
+                field = 'timestamp'
+                event_time = from_timestamp(event_ms // 1000)
+            except Exception as error:
+                invalid.append((record, InvalidRecord(field, error)))
+                continue
+            user_ids.append(format_uuid(user_id))
+            film_ids.append(format_uuid(film_id))
+            start_times.append(start_time)
+            end_times.append(end_time)
+            event_times.append(event_time)
+            continue
+
+        field = 'value'
+        try:
+            value = loads(raw)
+            field = 'user_id'
+            user_id = decode_uuid(value['user_id'])
+            field = 'film_id'
+            film_id = decode_uuid(value['film_id'])
+            field = 'start_time'
+            start_time = check_position(int(value['start_time']))
+            field = 'end_time'
+            end_time = check_position(int(value['end_time']))
+            field = 'timestamp'
+            event_time = decode_datetime(value['timestamp'])
+        except Exception as error:
+            invalid.append((record, InvalidRecord(field, error)))
+            continue
+
+        user_ids.append(user_id)
+        film_ids.append(film_id)
+        start_times.append(start_time)
+        end_times.append(end_time)
+        event_times.append(event_time.replace(tzinfo=None, microsecond=0))
+
+    return invalid
@@ -0,0 +1,127 @@
+from collections import deque
+from logging import getLogger
+from typing import Deque, Dict, Iterable, Optional, Tuple
+
+from kafka.structs import OffsetAndMetadata, TopicPartition
+
+from .schema import ViewBlock
+
+
+logger = getLogger(__name__)
+
+OffsetRange = Tuple[int, int]
+
+
+def format_ranges(ranges: Iterable[OffsetRange]) -> str:
+    return ','.join(f'{first}-{last}' for first, last in ranges)
+
+
+def parse_ranges(metadata: str) -> Deque[OffsetRange]:
+    ranges: Deque[OffsetRange] = deque()
+    for item in filter(None, metadata.split(',')):
+        first, last = item.split('-')
+        ranges.append((int(first), int(last)))
+    return ranges
+
+
+class OffsetTracker:
+    """Диапазоны офсетов, выданные в батчах, но еще не загруженные.
+
+    Вместе с зафиксированным офсетом партиции в метаданные коммита
+    записываются диапазоны батчей в работе. После перезапуска первые
+    блоки партиции нарезаются ровно по этим диапазонам, поэтому повторная
+    вставка получает те же токены дедупликации.
+    """
+
+    def __init__(self) -> None:
+        self.pending: Dict[TopicPartition, Deque[OffsetRange]] = {}
+        self.replay: Dict[TopicPartition, Deque[OffsetRange]] = {}
+
+    def knows(self, partition: TopicPartition) -> bool:
+        return partition in self.replay
+
+    def restore(
+        self,
+        partition: TopicPartition,
+        committed: Optional[OffsetAndMetadata]
+    ) -> None:
+        ranges: Deque[OffsetRange] = deque()
+        if committed and committed.metadata:
+            try:
+                ranges = parse_ranges(committed.metadata)
+            except ValueError:
+                logger.warning(
+                    'Неверные метаданные офсета %s: %s',
+                    partition, committed.metadata
+                )
+        self.replay[partition] = ranges
+        self.pending[partition] = deque()
+        if ranges:
+            logger.info(
+                'Partition %s: replaying in-flight ranges %s',
+                partition, format_ranges(ranges)
+            )
+
+    def has_pending(self) -> bool:
+        return any(self.pending.values())
+
+    def forget(self, partition: TopicPartition) -> None:
+        self.replay.pop(partition, None)
+        self.pending.pop(partition, None)
+
+    def replay_range(
+        self,
+        partition: TopicPartition
+    ) -> Optional[OffsetRange]:
+        ranges = self.replay.get(partition)
+        return ranges[0] if ranges else None
+
+    def replay_done(self, partition: TopicPartition) -> None:
+        self.replay[partition].popleft()
+
+    def drop_replay(self, partition: TopicPartition) -> None:
+        logger.warning(
+            'Partition %s: in-flight ranges %s cannot be replayed exactly',
+            partition, format_ranges(self.replay[partition])
+        )
+        self.replay[partition].clear()
+
+    def add(self, blocks: Iterable[ViewBlock]) -> None:
+        for block in blocks:
+            self.pending.setdefault(block.partition, deque()).append(
+                (block.first_offset, block.last_offset)
+            )
+
+    def fence(
+        self,
+        blocks: Iterable[ViewBlock]
+    ) -> Dict[TopicPartition, OffsetAndMetadata]:
+        """Офсеты для коммита до загрузки: позиция не сдвигается,
+        в метаданных - диапазоны в работе."""
+        return {
+            block.partition: self._position(block.partition, block)
+            for block in blocks
+        }
+
+    def acknowledge(
+        self,
+        blocks: Iterable[ViewBlock]
+    ) -> Dict[TopicPartition, OffsetAndMetadata]:
+        offsets = {}
+        for block in blocks:
+            pending = self.pending.get(block.partition)
+            if pending and pending[0] == (block.first_offset,
+                                          block.last_offset):
+                pending.popleft()
+            offsets[block.partition] = self._position(block.partition, block)
+        return offsets
+
+    def _position(
+        self,
+        partition: TopicPartition,
+        block: ViewBlock
+    ) -> OffsetAndMetadata:
+        pending = self.pending.get(partition)
+        if pending:
+            return OffsetAndMetadata(pending[0][0], format_ranges(pending))
+        return OffsetAndMetadata(block.last_offset + 1, '')
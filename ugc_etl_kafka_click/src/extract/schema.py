@@ -1,8 +1,10 @@
 from pydantic import BaseModel
 from uuid import UUID
-from typing import List
+from typing import List, NamedTuple
 from datetime import datetime
 
+from kafka.structs import TopicPartition
+
 
 class KafkaData(BaseModel):
     user_id: UUID
@@ -12,5 +14,58 @@ class KafkaData(BaseModel):
     timestamp: datetime
 
 
-class KafkaBulkData(BaseModel):
-    payload: List[KafkaData]
+class ViewBlock(NamedTuple):
+    """Строки батча [start, stop), прочитанные из одной партиции."""
+    partition: TopicPartition
+    first_offset: int
+    last_offset: int
+    start: int
+    stop: int
+
+    @property
+    def token(self) -> str:
+        # Одинаков для повторной загрузки того же диапазона офсетов
+        return '{0}-{1}-{2}-{3}'.format(
+            self.partition.topic,
+            self.partition.partition,
+            self.first_offset,
+            self.last_offset
+        )
+
+
+class ViewBatch:
+    """Колоночный батч событий просмотра: по списку на каждое поле."""
+
+    __slots__ = (
+        'user_id', 'film_id', 'start_time', 'end_time', 'event_time',
+        'blocks',
+    )
+
+    def __init__(self) -> None:
+        self.user_id: List[str] = []
+        self.film_id: List[str] = []
+        self.start_time: List[int] = []
+        self.end_time: List[int] = []
+        # Время события без таймзоны и микросекунд
+        self.event_time: List[datetime] = []
+        self.blocks: List[ViewBlock] = []
+
+    def __len__(self) -> int:
+        return len(self.user_id)
+
+    def extend(
+        self,
+        other: 'ViewBatch',
+        partition: TopicPartition,
+        first_offset: int,
+        last_offset: int
+    ) -> None:
+        start = len(self)
+        self.user_id.extend(other.user_id)
+        self.film_id.extend(other.film_id)
+        self.start_time.extend(other.start_time)
+        self.end_time.extend(other.end_time)
+        self.event_time.extend(other.event_time)
+        self.blocks.append(
+            ViewBlock(partition, first_offset, last_offset, start, len(self))
+        )
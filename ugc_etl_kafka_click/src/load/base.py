@@ -1,29 +1,137 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import monotonic
+from typing import Dict, List, Optional, Tuple, Union
 from clickhouse_driver import Client, errors
-from .schema import ClickhouseBulkData
+from .pressure import LoadPressure
+from .schema import ClickhouseBulkData, ClickhouseColumnarData
+from .shards import (
+    TOPOLOGY_QUERY, Replica, Shard, ShardRouter, read_topology
+)
+from .spool import Spool, merge_batches
+from core import metrics
 from core.config import settings
 import backoff
+from backoff.types import Details
 
 from logging import getLogger
 logger = getLogger(__name__)
 
+# Максимальное число активных кусков среди партиций таблицы на узле
+PARTS_QUERY = (
+    'SELECT max(parts) FROM ('
+    'SELECT count() AS parts FROM system.parts '
+    'WHERE active AND table = %(table)s '
+    'GROUP BY database, partition)'
+)
+
+
+# Ошибки, при которых батч уходит в спул
+UNAVAILABLE_ERRORS = (
+    errors.NetworkError,
+    errors.SocketTimeoutError,
+    ConnectionError,
+    EOFError,
+)
+
+
+def _too_many_parts(error: Exception) -> bool:
+    if not isinstance(error, errors.ServerException):
+        return False
+    return error.code == errors.ErrorCodes.TOO_MANY_PARTS
+
+
+def _unavailable(error: Exception) -> bool:
+    """Ошибка, после которой вставку можно повторить позже."""
+    return isinstance(error, UNAVAILABLE_ERRORS) or _too_many_parts(error)
+
+
+def _not_too_many_parts(error: errors.ServerException) -> bool:
+    return error.code != errors.ErrorCodes.TOO_MANY_PARTS
+
+
+def _on_too_many_parts(details: Details) -> None:
+    metrics.count_backoff(details)
+    loader = details['args'][0]
+    if loader.pressure:
+        loader.pressure.pause()
+
 
 class ClickhouseLoader:
-    def __init__(self, host: str) -> None:
+    def __init__(
+        self,
+        host: str,
+        pressure: Optional[LoadPressure] = None,
+        parts_table: Optional[str] = None,
+        spool: Optional[Spool] = None,
+        orphaned_spools: Optional[List[Spool]] = None,
+        cluster: Optional[str] = None,
+        client: Optional[Client] = None
+    ) -> None:
+        """parts_table - имя локальной таблицы на узлах кластера,
+        по ее кускам в system.parts оценивается нагрузка на ClickHouse.
+
+        Со spool батчи, которые не удалось вставить, сохраняются на диск
+        и считаются обработанными, офсеты Kafka после этого фиксируются.
+        Сохраненные батчи загружаются, когда ClickHouse снова доступен.
+        orphaned_spools - спулы других воркеров, оставшиеся без владельца,
+        они загружаются раньше своего и освобождаются, когда опустеют.
+
+        С cluster колоночные батчи вставляются не в Distributed-таблицу,
+        а напрямую в локальные таблицы шардов кластера, параллельно.
+
+        client - готовый клиент вместо подключения к host, например
+        заглушка в бенчмарке.
+        """
         self.host = host
-        self._client = None
+        self.pressure = pressure
+        self.parts_table = parts_table
+        self.spool = spool
+        self.orphaned_spools = list(orphaned_spools or [])
+        self.cluster = cluster
+        self._client = client
+        self._router: Optional[ShardRouter] = None
+        self._shard_clients: Dict[Tuple[str, int], Client] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._parts_checked_at = 0.0
+        self._spool_retry_at = 0.0
+        # Вставки и загрузка спула из фонового потока идут по очереди:
+        # клиент ClickHouse и спул не потокобезопасны
+        self._spool_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._idle_replay: Optional[threading.Thread] = None
+        self.loaded_rows = 0
 
     def __enter__(self):
+        if self._spooled():
+            self._replay_spool()
+        if self.spool is not None:
+            self._idle_replay = threading.Thread(
+                target=self._replay_idle,
+                name='etl-spool-replay',
+                daemon=True
+            )
+            self._idle_replay.start()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        try:
-            if self._client and self._client.connection.connected:
-                self.client.disconnect()
-        except Exception:
-            logger.exception(
-                'Возникла ошибка при закрытии соединения Clickouse, host=%s',
-                self.host
-            )
+        self._closed.set()
+        if self._idle_replay:
+            self._idle_replay.join()
+        if self._executor:
+            self._executor.shutdown()
+        clients = [self._client, *self._shard_clients.values()]
+        for client in clients:
+            try:
+                if client and client.connection.connected:
+                    client.disconnect()
+            except Exception:
+                logger.exception(
+                    'Возникла ошибка при закрытии соединения Clickouse, '
+                    'host=%s', client.connection.host
+                )
+        for spool in self._spools():
+            spool.unlock()
 
     @property
     def client(self) -> Client:
@@ -31,9 +139,309 @@ class ClickhouseLoader:
             self._client = Client(self.host)
         return self._client
 
+    def load(
+        self,
+        transformed_data: Union[ClickhouseBulkData, ClickhouseColumnarData]
+    ) -> None:
+        logger.info('Loading data %s rows', transformed_data.count)
+        spool = self.spool
+        if spool is None:
+            self._insert_timed(self._insert, transformed_data)
+            return
+
+        with self._spool_lock:
+            # Пока в спуле есть батчи, новые пишутся за ними, чтобы
+            # сохранить порядок загрузки
+            if self._spooled() and not self._replay_spool():
+                spool.append(transformed_data)
+                return
+            try:
+                self._insert_timed(self._execute, transformed_data)
+            except Exception as error:
+                if not _unavailable(error):
+                    raise
+                self._spool_unavailable(spool, transformed_data, error)
+
+    def _replay_idle(self) -> None:
+        """Загружает спул, когда новых батчей нет: иначе после сбоя
+        ClickHouse при остановившемся потоке сообщений спул ждал бы
+        следующей вставки."""
+        while not self._closed.wait(settings.spool_retry_interval):
+            with self._spool_lock:
+                if not self._spooled():
+                    continue
+                try:
+                    self._replay_spool()
+                except Exception:
+                    logger.exception('Ошибка загрузки спула')
+
+    def _insert_timed(
+        self,
+        insert,
+        transformed_data: Union[ClickhouseBulkData, ClickhouseColumnarData]
+    ) -> None:
+        started_at = monotonic()
+        insert(transformed_data)
+        elapsed = monotonic() - started_at
+        self.loaded_rows += transformed_data.count
+        metrics.ROWS_LOADED.labels(transformed_data.table).inc(
+            transformed_data.count
+        )
+        metrics.INSERT_LATENCY.observe(elapsed)
+        if self.pressure:
+            self.pressure.record_insert(elapsed)
+            if self.parts_table:
+                self._check_parts()
+
+    def _spool_unavailable(
+        self,
+        spool: Spool,
+        transformed_data: Union[ClickhouseBulkData, ClickhouseColumnarData],
+        error: Exception
+    ) -> None:
+        logger.warning(
+            'ClickHouse недоступен (%s), батч из %s строк записан в спул, '
+            'повторная попытка через %ss',
+            error, transformed_data.count, settings.spool_retry_interval
+        )
+        if _too_many_parts(error) and self.pressure:
+            self.pressure.pause()
+        spool.append(transformed_data)
+        self._spool_retry_at = monotonic() + settings.spool_retry_interval
+
+    def _spools(self) -> List[Spool]:
+        spools = list(self.orphaned_spools)
+        if self.spool is not None:
+            spools.append(self.spool)
+        return spools
+
+    def _spooled(self) -> bool:
+        return any(self._spools())
+
+    def _replay_spool(self) -> bool:
+        """Загружает батчи из спулов, объединяя их в крупные вставки.
+        Возвращает True, если спулы опустели."""
+        if monotonic() < self._spool_retry_at:
+            return False
+        try:
+            for spool in self._spools():
+                for segment in spool.sealed():
+                    self._replay_or_quarantine(spool, segment)
+        except Exception as error:
+            if not _unavailable(error):
+                raise
+            logger.warning(
+                'ClickHouse недоступен (%s), загрузка спула отложена на %ss',
+                error, settings.spool_retry_interval
+            )
+            self._spool_retry_at = monotonic() + settings.spool_retry_interval
+            return False
+        for spool in self.orphaned_spools:
+            logger.info('Orphaned spool %s replayed', spool.path)
+            spool.unlock()
+        self.orphaned_spools = []
+        return True
+
+    def _replay_or_quarantine(self, spool: Spool, segment: str) -> None:
+        # Сегмент, который ClickHouse отклоняет не из-за недоступности,
+        # откладывается: иначе он падал бы при каждом запуске воркера
+        try:
+            self._replay_segment(spool, segment)
+        except Exception as error:
+            if _unavailable(error):
+                raise
+            logger.error(
+                'Сегмент спула %s не загружен и отложен с суффиксом %s: %s',
+                segment, Spool.FAILED_SUFFIX, error, exc_info=True
+            )
+            spool.quarantine(segment)
+            return
+        spool.remove(segment)
+
+    def _replay_segment(self, spool: Spool, segment: str) -> None:
+        batches = []
+        rows = 0
+        for position, batch in spool.read(segment):
+            batches.append(batch)
+            rows += batch.count
+            if rows >= settings.spool_replay_max_rows:
+                self._replay_batches(batches)
+                spool.checkpoint(segment, position)
+                batches = []
+                rows = 0
+        if batches:
+            self._replay_batches(batches)
+
+    def _replay_batches(
+        self,
+        batches: List[Union[ClickhouseBulkData, ClickhouseColumnarData]]
+    ) -> None:
+        for transformed_data in merge_batches(batches):
+            logger.info('Replaying %s rows from spool', transformed_data.count)
+            self._insert_timed(self._execute, transformed_data)
+            metrics.SPOOL_REPLAYED_ROWS.inc(transformed_data.count)
+
+    # Отклоненная из-за TOO_MANY_PARTS вставка ничего не записывает,
+    # ее можно повторять, пока ClickHouse не сольет куски. Повторы
+    # ограничены по времени: в последовательном режиме загрузчик
+    # блокирует опрос Kafka, и без предела консьюмер исключат из группы
+    @backoff.on_exception(backoff.expo,
+                          errors.ServerException,
+                          giveup=_not_too_many_parts,
+                          max_value=settings.clickhouse_pressure_pause,
+                          max_time=settings.clickhouse_too_many_parts_max_time,
+                          on_backoff=_on_too_many_parts)
     @backoff.on_exception(backoff.expo,
                           (errors.NetworkError, ConnectionRefusedError),
-                          max_time=settings.backoff_max_time)
-    def load(self, transformed_data: ClickhouseBulkData) -> None:
-        logger.info('Loading data %s rows', transformed_data.count)
-        self.client.execute(transformed_data.query)
+                          max_time=settings.backoff_max_time,
+                          on_backoff=metrics.count_backoff)
+    def _insert(
+        self,
+        transformed_data: Union[ClickhouseBulkData, ClickhouseColumnarData]
+    ) -> None:
+        self._execute(transformed_data)
+
+    def _execute(
+        self,
+        transformed_data: Union[ClickhouseBulkData, ClickhouseColumnarData],
+        client: Optional[Client] = None
+    ) -> None:
+        if client is None:
+            if self.cluster and isinstance(
+                transformed_data, ClickhouseColumnarData
+            ):
+                self._execute_sharded(transformed_data)
+                return
+            client = self.client
+        if isinstance(transformed_data, ClickhouseColumnarData):
+            if transformed_data.blocks:
+                self._load_blocks(transformed_data, client)
+            else:
+                client.execute(
+                    transformed_data.query,
+                    transformed_data.data,
+                    columnar=True
+                )
+        else:
+            client.execute(transformed_data.query)
+
+    def _execute_sharded(
+        self,
+        transformed_data: ClickhouseColumnarData
+    ) -> None:
+        """Строки раскладываются по шардам по user_id и вставляются в
+        локальные таблицы шардов параллельно. При повторе после частичного
+        сбоя дубликаты на успевших шардах отбросит дедупликация по токенам
+        блоков, если она включена."""
+        router = self._router
+        if router is None:
+            shards = read_topology(
+                self.client.execute(TOPOLOGY_QUERY, {'cluster': self.cluster})
+            )
+            if not shards:
+                raise ValueError(
+                    f'Кластер {self.cluster} не найден в system.clusters'
+                )
+            router = self._router = ShardRouter(shards)
+            logger.info('Cluster %s: %s shards', self.cluster, len(shards))
+        executor = self._executor
+        if executor is None:
+            executor = self._executor = ThreadPoolExecutor(
+                max_workers=len(router.shards),
+                thread_name_prefix='etl-shard'
+            )
+        parts = router.split(transformed_data)
+        futures = [
+            executor.submit(self._insert_shard, shard, part)
+            for shard, part in parts
+        ]
+        wait(futures)
+        for future in futures:
+            error = future.exception()
+            if error:
+                # Топология будет прочитана заново при следующей вставке
+                self._router = None
+                raise error
+
+    def _insert_shard(
+        self,
+        shard: Shard,
+        transformed_data: ClickhouseColumnarData
+    ) -> None:
+        """Вставка в первую доступную реплику шарда, остальные получат
+        данные репликацией."""
+        local_table = transformed_data.table.rsplit('.', 1)[-1]
+        last_error: Optional[Exception] = None
+        for replica in shard.replicas:
+            database = replica.database or transformed_data.table.split('.')[0]
+            data = transformed_data.copy(
+                update={'table': f'{database}.{local_table}'}
+            )
+            try:
+                self._execute(data, self._shard_client(replica))
+                return
+            except UNAVAILABLE_ERRORS as error:
+                logger.warning(
+                    'Реплика %s:%s шарда %s недоступна: %s',
+                    replica.host, replica.port, shard.number, error
+                )
+                last_error = error
+        if last_error is None:
+            raise ValueError(
+                f'У шарда {shard.number} кластера {self.cluster} нет реплик'
+            )
+        raise last_error
+
+    def _shard_client(self, replica: Replica) -> Client:
+        key = (replica.host, replica.port)
+        client = self._shard_clients.get(key)
+        if not client or not client.connection.connected:
+            client = Client(replica.host, port=replica.port)
+            self._shard_clients[key] = client
+        return client
+
+    def _load_blocks(
+        self,
+        transformed_data: ClickhouseColumnarData,
+        client: Client
+    ) -> None:
+        """Каждый блок вставляется со своим токеном: при повторе после
+        сбоя ClickHouse отбросит уже загруженные блоки. Повтор этого метода
+        через backoff также безопасен."""
+        data = transformed_data.data
+        for token, start, stop in transformed_data.blocks:
+            if start == 0 and stop == transformed_data.count:
+                block = data
+            else:
+                block = [column[start:stop] for column in data]
+            client.execute(
+                transformed_data.query,
+                block,
+                columnar=True,
+                settings={
+                    'insert_deduplication_token': token,
+                    'insert_distributed_sync': 1,
+                }
+            )
+
+    def _check_parts(self) -> None:
+        pressure = self.pressure
+        if pressure is None:
+            return
+        now = monotonic()
+        interval = settings.clickhouse_parts_check_interval
+        if now - self._parts_checked_at < interval:
+            return
+        self._parts_checked_at = now
+        try:
+            rows = self.client.execute(
+                PARTS_QUERY, {'table': self.parts_table}
+            )
+        except errors.Error:
+            logger.warning(
+                'Не удалось получить число кусков таблицы %s',
+                self.parts_table,
+                exc_info=True
+            )
+            return
+        pressure.record_parts(rows[0][0] if rows else 0)
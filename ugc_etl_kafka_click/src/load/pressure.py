@@ -0,0 +1,87 @@
+from logging import getLogger
+from time import monotonic
+
+from core import metrics
+
+
+logger = getLogger(__name__)
+
+
+class LoadPressure:
+    """Оценка нагрузки на ClickHouse по времени вставки и числу активных
+    кусков в партиции таблицы.
+
+    Загрузчик сообщает замеры, читатель Kafka по ним укрупняет батчи
+    (меньше вставок - меньше новых кусков) или ставит партиции на паузу,
+    пока ClickHouse не успеет слить куски.
+    """
+
+    # Сглаживание времени вставки
+    LATENCY_WEIGHT = 0.3
+
+    def __init__(
+        self,
+        latency_target: float,
+        parts_soft_limit: int,
+        parts_hard_limit: int,
+        max_batch_scale: float,
+        pause_time: float
+    ) -> None:
+        self.latency_target = latency_target
+        self.parts_soft_limit = parts_soft_limit
+        self.parts_hard_limit = parts_hard_limit
+        self.max_batch_scale = max_batch_scale
+        self.pause_time = pause_time
+        self.latency = 0.0
+        self.parts = 0
+        self.batch_scale = 1.0
+        self._paused_until = 0.0
+
+    @property
+    def paused(self) -> bool:
+        return monotonic() < self._paused_until
+
+    def record_insert(self, seconds: float) -> None:
+        if self.latency:
+            self.latency += self.LATENCY_WEIGHT * (seconds - self.latency)
+        else:
+            self.latency = seconds
+        self._adjust()
+
+    def record_parts(self, parts: int) -> None:
+        self.parts = parts
+        metrics.CLICKHOUSE_ACTIVE_PARTS.set(parts)
+        if parts >= self.parts_hard_limit:
+            self.pause()
+        self._adjust()
+
+    def pause(self) -> None:
+        """Чтение из Kafka приостанавливается на pause_time секунд,
+        батчи после паузы собираются максимального размера."""
+        if not self.paused:
+            logger.warning(
+                'ClickHouse перегружен (кусков в партиции: %s, '
+                'время вставки %.2fs), чтение из Kafka приостановлено '
+                'на %ss', self.parts, self.latency, self.pause_time
+            )
+        self._paused_until = monotonic() + self.pause_time
+        self._set_scale(self.max_batch_scale)
+
+    def _adjust(self) -> None:
+        slow = self.latency > self.latency_target
+        many_parts = self.parts >= self.parts_soft_limit
+        if slow or many_parts:
+            self._set_scale(self.batch_scale * 2)
+            return
+        fast = self.latency < self.latency_target / 2
+        few_parts = self.parts < self.parts_soft_limit / 2
+        if fast and few_parts:
+            self._set_scale(self.batch_scale / 2)
+
+    def _set_scale(self, scale: float) -> None:
+        scale = min(max(scale, 1.0), self.max_batch_scale)
+        if scale != self.batch_scale:
+            logger.info('Batch scale changed: %.2f -> %.2f',
+                        self.batch_scale, scale)
+            self.batch_scale = scale
+            metrics.BATCH_SCALE.set(scale)
@@ -1,6 +1,22 @@
+from typing import List, Tuple
 from pydantic import BaseModel
 
 
 class ClickhouseBulkData(BaseModel):
     count: int
+    table: str
     query: str
+
+
+class ClickhouseColumnarData(BaseModel):
+    count: int
+    table: str
+    columns: List[str]
+    data: List[list]
+    # (токен дедупликации, начало, конец) - строки, которые вставляются
+    # отдельным запросом со своим токеном
+    blocks: List[Tuple[str, int, int]] = []
+
+    @property
+    def query(self) -> str:
+        return f"INSERT INTO {self.table} ({', '.join(self.columns)}) VALUES"
@@ -0,0 +1,96 @@
+import zlib
+from typing import Dict, List, NamedTuple, Tuple
+
+from .schema import ClickhouseColumnarData
+
+
+# Шарды кластера с весами и репликами. default_database реплики -
+# база локальной таблицы, в которую пишет Distributed-таблица
+TOPOLOGY_QUERY = (
+    'SELECT shard_num, shard_weight, replica_num, host_name, port, '
+    'default_database FROM system.clusters '
+    'WHERE cluster = %(cluster)s ORDER BY shard_num, replica_num'
+)
+
+
+class Replica(NamedTuple):
+    host: str
+    port: int
+    database: str
+
+
+class Shard(NamedTuple):
+    number: int
+    weight: int
+    replicas: Tuple[Replica, ...]
+
+
+def read_topology(rows: List[tuple]) -> List[Shard]:
+    """Шарды из строк TOPOLOGY_QUERY."""
+    shards: Dict[int, Tuple[int, List[Replica]]] = {}
+    for number, weight, _, host, port, database in rows:
+        shards.setdefault(number, (weight, []))[1].append(
+            Replica(host, port, database)
+        )
+    return [
+        Shard(number, weight, tuple(replicas))
+        for number, (weight, replicas) in sorted(shards.items())
+    ]
+
+
+def shard_key(user_id: str) -> int:
+    """Совпадает с ключом шардирования CRC32(user_id) Distributed-таблиц."""
+    return zlib.crc32(user_id.encode())
+
+
+class ShardRouter:
+    """Раскладывает строки по шардам так же, как Distributed-таблица:
+    остаток от деления ключа на сумму весов указывает на шард, шардам
+    по порядку отведено столько остатков, каков их вес."""
+
+    def __init__(self, shards: List[Shard]) -> None:
+        self.shards = shards
+        self.slots: List[int] = []
+        for index, shard in enumerate(shards):
+            self.slots.extend([index] * shard.weight)
+
+    def split(
+        self,
+        data: ClickhouseColumnarData,
+        key_column: str = 'user_id'
+    ) -> List[Tuple[Shard, ClickhouseColumnarData]]:
+        """Части батча по шардам. Блоки дедупликации сохраняют токены:
+        каждый шард дедуплицирует вставки в своей таблице."""
+        slots = self.slots
+        slots_count = len(slots)
+        keys = data.data[data.columns.index(key_column)]
+        targets = [slots[shard_key(key) % slots_count] for key in keys]
+
+        indexes: List[List[int]] = [[] for _ in self.shards]
+        blocks: List[list] = [[] for _ in self.shards]
+        block_ranges = data.blocks or [('', 0, data.count)]
+        for token, start, stop in block_ranges:
+            starts = [len(shard_indexes) for shard_indexes in indexes]
+            for row in range(start, stop):
+                indexes[targets[row]].append(row)
+            for shard, shard_indexes in enumerate(indexes):
+                if len(shard_indexes) > starts[shard]:
+                    blocks[shard].append(
+                        (token, starts[shard], len(shard_indexes))
+                    )
+
+        result = []
+        for shard, shard_indexes in enumerate(indexes):
+            if not shard_indexes:
+                continue
+            result.append((self.shards[shard], ClickhouseColumnarData(
+                count=len(shard_indexes),
+                table=data.table,
+                columns=data.columns,
+                data=[
+                    [column[row] for row in shard_indexes]
+                    for column in data.data
+                ],
+                blocks=blocks[shard] if data.blocks else []
+            )))
+        return result
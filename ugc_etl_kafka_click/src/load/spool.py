@@ -0,0 +1,246 @@
+import fcntl
+import mmap
+import os
+import pickle
+import struct
+import zlib
+from logging import getLogger
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from .schema import ClickhouseBulkData, ClickhouseColumnarData
+from core import metrics
+
+
+logger = getLogger(__name__)
+
+SpooledBatch = Union[ClickhouseBulkData, ClickhouseColumnarData]
+
+
+class Spool:
+    """Батчи, не загруженные в ClickHouse, в файлах-сегментах на диске.
+
+    В сегмент записи только дописываются: длина и crc32 данных, затем
+    батч в pickle. Запись считается сохраненной после fsync. Сегменты
+    читаются через mmap от старых к новым, позиция дочитанного сегмента
+    сохраняется в файле рядом с ним. Неполная запись в конце сегмента
+    (сбой во время записи) при чтении отбрасывается.
+
+    Каталог блокируется flock на время жизни спула, чтобы его не
+    загружали два процесса. С blocking=False занятый каталог вызывает
+    BlockingIOError.
+    """
+
+    HEADER = struct.Struct('<II')
+    PREFIX = 'segment-'
+    SUFFIX = '.spool'
+    FAILED_SUFFIX = '.failed'
+    LOCK_NAME = '.lock'
+
+    def __init__(
+        self,
+        path: str,
+        segment_max_bytes: int,
+        blocking: bool = True
+    ) -> None:
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.segment_max_bytes = segment_max_bytes
+        self._lock = self._acquire_lock(blocking)
+        self.segments: List[str] = sorted(
+            os.path.join(path, name) for name in os.listdir(path)
+            if name.startswith(self.PREFIX) and name.endswith(self.SUFFIX)
+        )
+        self._file = None
+        self._update_size()
+        if self.segments:
+            logger.info('Spool %s: %s segments, %s bytes to replay',
+                        path, len(self.segments), self.size)
+
+    def __bool__(self) -> bool:
+        return bool(self.segments)
+
+    def close(self) -> None:
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def unlock(self) -> None:
+        self.close()
+        if self._lock is not None:
+            os.close(self._lock)
+            self._lock = None
+
+    def append(self, batch: SpooledBatch) -> None:
+        payload = pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)
+        file = self._writable()
+        file.write(self.HEADER.pack(len(payload), zlib.crc32(payload)))
+        file.write(payload)
+        file.flush()
+        os.fsync(file.fileno())
+        self.size += self.HEADER.size + len(payload)
+        metrics.SPOOL_BYTES.set(self.size)
+        metrics.SPOOLED_ROWS.inc(batch.count)
+
+    def sealed(self) -> List[str]:
+        """Сегменты для чтения. Текущий сегмент закрывается, новые
+        батчи будут записаны в следующий."""
+        self.close()
+        return list(self.segments)
+
+    def read(self, segment: str) -> Iterator[Tuple[int, SpooledBatch]]:
+        """Батчи сегмента после сохраненной позиции вместе с позицией
+        конца каждого батча."""
+        position = self._load_position(segment)
+        with open(segment, 'rb') as file:
+            length = os.fstat(file.fileno()).st_size
+            if length <= position:
+                return
+            with mmap.mmap(
+                file.fileno(), 0, access=mmap.ACCESS_READ
+            ) as data:
+                while position + self.HEADER.size <= length:
+                    size, crc = self.HEADER.unpack_from(data, position)
+                    start = position + self.HEADER.size
+                    payload = data[start:start + size]
+                    if len(payload) < size or zlib.crc32(payload) != crc:
+                        logger.warning(
+                            'Неполная запись в сегменте %s на позиции %s, '
+                            'остаток сегмента пропущен', segment, position
+                        )
+                        return
+                    position = start + size
+                    yield position, pickle.loads(payload)
+
+    def checkpoint(self, segment: str, position: int) -> None:
+        temp_path = self._position_path(segment) + '.tmp'
+        with open(temp_path, 'w') as file:
+            file.write(str(position))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self._position_path(segment))
+
+    def remove(self, segment: str) -> None:
+        os.remove(segment)
+        position_path = self._position_path(segment)
+        if os.path.exists(position_path):
+            os.remove(position_path)
+        self.segments.remove(segment)
+        self._update_size()
+
+    def quarantine(self, segment: str) -> None:
+        """Убирает из очереди сегмент, который ClickHouse не принимает,
+        файл с позицией остается рядом с суффиксом .failed для разбора."""
+        failed = segment + self.FAILED_SUFFIX
+        position_path = self._position_path(segment)
+        if os.path.exists(position_path):
+            os.replace(position_path, self._position_path(failed))
+        os.replace(segment, failed)
+        self._sync_directory()
+        self.segments.remove(segment)
+        self._update_size()
+        metrics.SPOOL_QUARANTINED_SEGMENTS.inc()
+
+    def _acquire_lock(self, blocking: bool) -> Optional[int]:
+        fd = os.open(
+            os.path.join(self.path, self.LOCK_NAME), os.O_RDWR | os.O_CREAT
+        )
+        operation = fcntl.LOCK_EX
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, operation)
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    def _writable(self):
+        if self._file and self._file.tell() >= self.segment_max_bytes:
+            self.close()
+        if self._file is None:
+            segment = os.path.join(
+                self.path,
+                f'{self.PREFIX}{self._next_number():012d}{self.SUFFIX}'
+            )
+            self._file = open(segment, 'ab')
+            self._sync_directory()
+            self.segments.append(segment)
+        return self._file
+
+    def _next_number(self) -> int:
+        if not self.segments:
+            return 0
+        name = os.path.basename(self.segments[-1])
+        return int(name[len(self.PREFIX):-len(self.SUFFIX)]) + 1
+
+    def _sync_directory(self) -> None:
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _position_path(self, segment: str) -> str:
+        return segment + '.pos'
+
+    def _load_position(self, segment: str) -> int:
+        try:
+            with open(self._position_path(segment)) as file:
+                return int(file.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _update_size(self) -> None:
+        self.size = sum(os.path.getsize(path) for path in self.segments)
+        metrics.SPOOL_BYTES.set(self.size)
+
+
+def orphaned_spools(
+    root: str,
+    workers_count: int,
+    segment_max_bytes: int
+) -> List[Spool]:
+    """Непустые спулы воркеров с номерами от workers_count и выше,
+    оставшиеся после уменьшения числа воркеров. Спулы, занятые другим
+    процессом, пропускаются."""
+    spools = []
+    for name in sorted(os.listdir(root)):
+        if not name.isdigit() or int(name) < workers_count:
+            continue
+        try:
+            spool = Spool(
+                os.path.join(root, name), segment_max_bytes, blocking=False
+            )
+        except BlockingIOError:
+            continue
+        if spool:
+            spools.append(spool)
+        else:
+            spool.unlock()
+    return spools
+
+
+def merge_batches(
+    batches: List[SpooledBatch]
+) -> Iterator[SpooledBatch]:
+    """Объединяет колоночные батчи каждой таблицы в один, чтобы повторить
+    их одной вставкой, порядок батчей внутри таблицы сохраняется. Блоки
+    с токенами дедупликации сдвигаются на позицию в объединенном батче."""
+    merged: Dict[tuple, ClickhouseColumnarData] = {}
+    for batch in batches:
+        if not isinstance(batch, ClickhouseColumnarData):
+            yield batch
+            continue
+        key = (batch.table, tuple(batch.columns), bool(batch.blocks))
+        target = merged.get(key)
+        if target is None:
+            merged[key] = batch
+            continue
+        for column, values in zip(target.data, batch.data):
+            column.extend(values)
+        target.blocks.extend(
+            (token, start + target.count, stop + target.count)
+            for token, start, stop in batch.blocks
+        )
+        target.count += batch.count
+    yield from merged.values()
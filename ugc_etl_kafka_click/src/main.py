@@ -1,31 +1,112 @@
+import os
+import signal
+from typing import Tuple
 from extract.base import KafkaExtractor
+from extract.schema import ViewBatch
 from transform.base import Transformer
 from load.base import ClickhouseLoader
+from load.pressure import LoadPressure
+from load.spool import Spool, orphaned_spools
+from pipeline import Pipeline
 from logging import getLogger
-from time import sleep
 from core.config import settings
+from core.metrics import start_metrics_server
 
 
 logger = getLogger(__name__)
 
 
+def run(extractor: KafkaExtractor, loader: ClickhouseLoader) -> None:
+    transofmer = Transformer(
+        settings.clickhouse_insert_mode,
+        settings.clickhouse_insert_dedup,
+        settings.clickhouse_latest_tablename
+    )
+
+    def load(view_batch: ViewBatch) -> None:
+        for transformed_data in transofmer.transform_batch(
+            view_batch,
+            settings.clickhouse_tablename
+        ):
+            loader.load(transformed_data)
+
+    if settings.etl_mode == 'pipeline':
+        Pipeline(
+            extractor,
+            transofmer,
+            loader,
+            settings.clickhouse_tablename,
+            settings.pipeline_queue_size
+        ).run()
+        return
+
+    extractor.flush_handler = load
+    for view_batch in extractor.get_updates():
+        if view_batch:
+            load(view_batch)
+
+
+def stop_on_sigterm(extractor: KafkaExtractor) -> None:
+    """По SIGTERM текущий батч загружается, офсеты фиксируются,
+    и только затем консьюмер выходит из группы."""
+    def stop(signum, frame):
+        logger.info('Signal %s received, flushing current batch', signum)
+        extractor.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+
+
+def create_etl(
+    worker_id: int = 0,
+    workers_count: int = 1
+) -> Tuple[KafkaExtractor, ClickhouseLoader]:
+    """Читатель и загрузчик, связанные общей оценкой нагрузки
+    на ClickHouse. У каждого воркера свой каталог спула, спулы воркеров
+    с номерами от workers_count загружает тот, кто первым их займет."""
+    pressure = LoadPressure(
+        settings.clickhouse_latency_target,
+        settings.clickhouse_parts_soft_limit,
+        settings.clickhouse_parts_hard_limit,
+        settings.batch_max_scale,
+        settings.clickhouse_pressure_pause
+    )
+    extractor = KafkaExtractor(
+        settings.kafka_topic,
+        settings.kafka_server,
+        settings.kafka_groupid,
+        pressure=pressure
+    )
+    spool = None
+    orphans = None
+    if settings.spool_dir:
+        spool = Spool(
+            os.path.join(settings.spool_dir, str(worker_id)),
+            settings.spool_segment_max_bytes
+        )
+        orphans = orphaned_spools(
+            settings.spool_dir,
+            workers_count,
+            settings.spool_segment_max_bytes
+        )
+    loader = ClickhouseLoader(
+        settings.clickhouse_host,
+        pressure,
+        # Distributed-таблица пишет в одноименные локальные таблицы
+        settings.clickhouse_tablename.rsplit('.', 1)[-1],
+        spool,
+        orphans,
+        settings.clickhouse_cluster
+        if settings.clickhouse_insert_target == 'shards' else None
+    )
+    return extractor, loader
+
+
 def main():
-    transofmer = Transformer()
-    with KafkaExtractor(
-            settings.kafka_topic,
-            settings.kafka_server,
-            settings.kafka_groupid
-        ) as extractor, \
-            ClickhouseLoader(settings.clickhouse_host) as loader:
-
-        for kafka_bulk_data in extractor.get_updates():
-            if kafka_bulk_data.payload:
-                transformed_data = transofmer.kafka_to_clickhouse(
-                    kafka_bulk_data,
-                    settings.clickhouse_tablename
-                )
-                loader.load(transformed_data)
-            sleep(settings.sleep_interval)
+    start_metrics_server(settings.metrics_port)
+    extractor, loader = create_etl()
+    stop_on_sigterm(extractor)
+    with extractor, loader:
+        run(extractor, loader)
 
 
 if __name__ == "__main__":
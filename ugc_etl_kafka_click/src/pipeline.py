@@ -0,0 +1,132 @@
+import threading
+from logging import getLogger
+from queue import Empty, Full, Queue
+from typing import Any, Callable, Optional
+
+from extract.base import KafkaExtractor
+from extract.schema import ViewBatch
+from load.base import ClickhouseLoader
+from transform.base import Transformer
+
+
+logger = getLogger(__name__)
+
+
+class PipelineStopped(Exception):
+    pass
+
+
+class Pipeline:
+    """Извлечение, трансформация и загрузка в отдельных потоках.
+
+    Стадии связаны ограниченными очередями: медленная загрузка заполняет
+    очереди и притормаживает чтение из Kafka. Офсеты батча фиксируются
+    только после того, как ClickHouse подтвердил вставку.
+
+    При отзыве партиций и остановке батчи в очередях догружаются,
+    а их офсеты фиксируются до того, как партиции отданы.
+    """
+
+    def __init__(
+        self,
+        extractor: KafkaExtractor,
+        transformer: Transformer,
+        loader: ClickhouseLoader,
+        table_name: str,
+        queue_size: int
+    ) -> None:
+        self.extractor = extractor
+        self.transformer = transformer
+        self.loader = loader
+        self.table_name = table_name
+        self.transform_queue: Queue = Queue(maxsize=queue_size)
+        self.load_queue: Queue = Queue(maxsize=queue_size)
+        self._error: Optional[BaseException] = None
+        self._stopped = threading.Event()
+        extractor.flush_handler = self._flush
+
+    def run(self) -> None:
+        workers = [
+            threading.Thread(target=self._stage, name='etl-transform',
+                             args=(self._transform, self.transform_queue)),
+            threading.Thread(target=self._stage, name='etl-load',
+                             args=(self._load, self.load_queue)),
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            for view_batch in self.extractor.get_updates(commit=False):
+                self._put(
+                    self.transform_queue,
+                    view_batch,
+                    on_wait=self.extractor.commit_acknowledged
+                )
+            # Генератор завершился после stop(): догружаем очереди
+            self.extractor.wait_acknowledged(abort=self._stopped)
+        except PipelineStopped:
+            pass
+        finally:
+            self._stopped.set()
+            for worker in workers:
+                worker.join()
+        if self._error:
+            raise self._error
+
+    def _stage(self, handler, queue: Queue) -> None:
+        try:
+            while not self._stopped.is_set():
+                try:
+                    item = queue.get(timeout=1)
+                except Empty:
+                    continue
+                handler(item)
+        except PipelineStopped:
+            pass
+        except BaseException as error:
+            logger.exception(
+                'Ошибка в потоке %s', threading.current_thread().name
+            )
+            self._error = error
+            self._stopped.set()
+
+    def _transform(self, view_batch: ViewBatch) -> None:
+        transformed_data = []
+        if view_batch:
+            transformed_data = self.transformer.transform_batch(
+                view_batch,
+                self.table_name
+            )
+        self._put(
+            self.load_queue,
+            (transformed_data, view_batch.blocks)
+        )
+
+    def _load(self, item) -> None:
+        transformed_data, blocks = item
+        for data in transformed_data:
+            self.loader.load(data)
+        self.extractor.acknowledge(blocks)
+
+    def _flush(self, view_batch: ViewBatch) -> None:
+        """Загрузка в потоке чтения, пока очереди пусты."""
+        for data in self.transformer.transform_batch(
+            view_batch,
+            self.table_name
+        ):
+            self.loader.load(data)
+
+    def _put(
+        self,
+        queue: Queue,
+        item: Any,
+        on_wait: Optional[Callable[[], None]] = None
+    ) -> None:
+        while True:
+            if self._stopped.is_set():
+                raise PipelineStopped()
+            try:
+                queue.put(item, timeout=1)
+                return
+            except Full:
+                if on_wait:
+                    on_wait()
@@ -0,0 +1,169 @@
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from queue import Empty
+from dataclasses import dataclass
+from logging import getLogger
+from typing import Dict, List
+
+from core.config import settings
+from core.metrics import start_metrics_server
+from extract.base import KafkaExtractor
+from load.base import ClickhouseLoader
+from main import create_etl, run, stop_on_sigterm
+
+
+logger = getLogger(__name__)
+
+
+@dataclass
+class WorkerReport:
+    worker_id: int
+    pid: int
+    partitions: List[str]
+    loaded_rows: int
+    reported_at: float
+
+
+def report_progress(
+    worker_id: int,
+    extractor: KafkaExtractor,
+    loader: ClickhouseLoader,
+    reports: multiprocessing.Queue,
+    interval: float
+) -> None:
+    while True:
+        time.sleep(interval)
+        partitions = sorted(
+            f'{partition.topic}-{partition.partition}'
+            for partition in extractor.assigned_partitions()
+        )
+        reports.put(WorkerReport(
+            worker_id=worker_id,
+            pid=os.getpid(),
+            partitions=partitions,
+            loaded_rows=loader.loaded_rows,
+            reported_at=time.time()
+        ))
+
+
+def worker(
+    worker_id: int,
+    workers_count: int,
+    reports: multiprocessing.Queue
+) -> None:
+    # Обработчик SIGTERM супервизора наследуется при fork
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    start_metrics_server(settings.metrics_port + worker_id)
+    extractor, loader = create_etl(worker_id, workers_count)
+    stop_on_sigterm(extractor)
+    with extractor, loader:
+        threading.Thread(
+            target=report_progress,
+            args=(worker_id, extractor, loader, reports,
+                  settings.supervisor_report_interval),
+            daemon=True
+        ).start()
+        run(extractor, loader)
+
+
+class Supervisor:
+    """Запускает воркеров ETL в одной группе потребителей Kafka,
+    перезапускает упавших и пишет в лог их партиции и пропускную
+    способность."""
+
+    def __init__(self, workers_count: int, max_restart_delay: float) -> None:
+        self.workers_count = workers_count
+        self.max_restart_delay = max_restart_delay
+        self.reports: multiprocessing.Queue = multiprocessing.Queue()
+        self.processes: Dict[int, multiprocessing.Process] = {}
+        self.restarts: Dict[int, int] = {}
+        self.restart_at: Dict[int, float] = {}
+        self.last_reports: Dict[int, WorkerReport] = {}
+        self._stopping = False
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._stop)
+        for worker_id in range(self.workers_count):
+            self._start_worker(worker_id)
+        try:
+            while not self._stopping:
+                self._check_workers()
+                self._collect_reports(timeout=1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._shutdown()
+
+    def _stop(self, signum, frame) -> None:
+        logger.info('Получен сигнал %s, остановка воркеров', signum)
+        self._stopping = True
+
+    def _start_worker(self, worker_id: int) -> None:
+        process = multiprocessing.Process(
+            target=worker,
+            args=(worker_id, self.workers_count, self.reports),
+            name=f'etl-worker-{worker_id}'
+        )
+        process.start()
+        self.processes[worker_id] = process
+        self.restart_at.pop(worker_id, None)
+        logger.info('Worker %s started, pid=%s', worker_id, process.pid)
+
+    def _check_workers(self) -> None:
+        now = time.monotonic()
+        for worker_id, process in self.processes.items():
+            if process.is_alive():
+                continue
+            if worker_id not in self.restart_at:
+                restarts = self.restarts.get(worker_id, 0)
+                delay = min(2 ** restarts, self.max_restart_delay)
+                self.restarts[worker_id] = restarts + 1
+                self.restart_at[worker_id] = now + delay
+                logger.error(
+                    'Воркер %s (pid=%s) завершился с кодом %s, '
+                    'перезапуск через %s с',
+                    worker_id, process.pid, process.exitcode, delay
+                )
+            elif now >= self.restart_at[worker_id]:
+                self._start_worker(worker_id)
+
+    def _collect_reports(self, timeout: float) -> None:
+        try:
+            report: WorkerReport = self.reports.get(timeout=timeout)
+        except Empty:
+            return
+        # Воркер проработал интервал отчета - сбрасываем задержку перезапуска
+        self.restarts.pop(report.worker_id, None)
+        previous = self.last_reports.get(report.worker_id)
+        self.last_reports[report.worker_id] = report
+        if previous and previous.pid == report.pid:
+            loaded_rows = report.loaded_rows - previous.loaded_rows
+            elapsed = report.reported_at - previous.reported_at
+            rows_per_second = loaded_rows / elapsed
+        else:
+            rows_per_second = report.loaded_rows / settings.supervisor_report_interval
+        logger.info(
+            'Worker %s (pid=%s): partitions=[%s], %.1f rows/s, %s rows total',
+            report.worker_id, report.pid, ', '.join(report.partitions),
+            rows_per_second, report.loaded_rows
+        )
+
+    def _shutdown(self) -> None:
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        # Воркер догружает батчи в работе перед выходом
+        for process in self.processes.values():
+            process.join(timeout=settings.rebalance_flush_timeout + 10)
+            if process.is_alive():
+                process.kill()
+
+
+if __name__ == '__main__':
+    Supervisor(
+        settings.etl_workers or os.cpu_count() or 1,
+        settings.supervisor_max_restart_delay
+    ).run()
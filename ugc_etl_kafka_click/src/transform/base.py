@@ -1,29 +1,102 @@
 from logging import getLogger
-from extract.schema import KafkaBulkData
-from load.schema import ClickhouseBulkData
+from typing import List, Optional, Union
+from extract.schema import ViewBatch
+from load.schema import ClickhouseBulkData, ClickhouseColumnarData
+from .latest import latest_positions
 
 
 logger = getLogger(__name__)
 
+CLICKHOUSE_COLUMNS = ['user_id', 'film_id', 'start_time', 'end_time', 'event_time'] # noqa
+
 
 class Transformer:
 
-    def __init__(self) -> None:
-        pass
+    def __init__(
+        self,
+        insert_mode: str = 'sql',
+        dedup: bool = False,
+        latest_table: Optional[str] = None
+    ) -> None:
+        """latest_table - таблица последних позиций просмотра, в нее
+        вместе с батчем пишется по одной строке на пару user_id/film_id."""
+        self.insert_mode = insert_mode
+        self.dedup = dedup
+        self.latest_table = latest_table
+
+    def transform_batch(
+        self,
+        view_batch: ViewBatch,
+        click_table_name: str
+    ) -> List[Union[ClickhouseBulkData, ClickhouseColumnarData]]:
+        """Вставки батча: все события и, если задана latest_table,
+        последние позиции."""
+        result = [self.transform(view_batch, click_table_name)]
+        if self.latest_table:
+            latest = latest_positions(view_batch)
+            logger.info('Latest positions: %s of %s rows',
+                        len(latest), len(view_batch))
+            result.append(self.transform(latest, self.latest_table))
+        return result
+
+    def transform(
+        self,
+        view_batch: ViewBatch,
+        click_table_name: str
+    ) -> Union[ClickhouseBulkData, ClickhouseColumnarData]:
+        if self.insert_mode == 'columnar':
+            return self.kafka_to_clickhouse_columnar(
+                view_batch,
+                click_table_name
+            )
+        return self.kafka_to_clickhouse(view_batch, click_table_name)
 
     def kafka_to_clickhouse(
         self,
-        kafka_bulk_data: KafkaBulkData,
+        view_batch: ViewBatch,
         click_table_name: str
     ) -> ClickhouseBulkData:
         query_strings = [f"INSERT INTO {click_table_name} (user_id, film_id, start_time, end_time, event_time) VALUES "] # noqa
-        for row in kafka_bulk_data.payload:
-            timestamp = row.timestamp.replace(tzinfo=None, microsecond=0)
-            query_strings.append(
-                f"('{row.user_id}', '{row.film_id}', {row.start_time}, {row.end_time}, '{timestamp}')," # noqa
-            )
+        for row in zip(
+            view_batch.user_id,
+            view_batch.film_id,
+            view_batch.start_time,
+            view_batch.end_time,
+            view_batch.event_time
+        ):
+            query_strings.append("('%s', '%s', %s, %s, '%s')," % row)
         result = ClickhouseBulkData(
             query=''.join(query_strings),
+            table=click_table_name,
             count=len(query_strings) - 1
         )
         return result
+
+    def kafka_to_clickhouse_columnar(
+        self,
+        view_batch: ViewBatch,
+        click_table_name: str
+    ) -> ClickhouseColumnarData:
+        # Колонки батча уходят в native-протокол clickhouse_driver как есть.
+        # Драйвер заменяет datetime на timestamp прямо в переданном списке,
+        # поэтому event_time копируется
+        data = [
+            view_batch.user_id,
+            view_batch.film_id,
+            view_batch.start_time,
+            view_batch.end_time,
+            list(view_batch.event_time),
+        ]
+        blocks = []
+        if self.dedup:
+            blocks = [
+                (block.token, block.start, block.stop)
+                for block in view_batch.blocks
+            ]
+        return ClickhouseColumnarData(
+            count=len(view_batch),
+            table=click_table_name,
+            columns=CLICKHOUSE_COLUMNS,
+            data=data,
+            blocks=blocks
+        )
@@ -0,0 +1,36 @@
+from typing import Dict, Tuple
+
+from extract.schema import ViewBatch
+
+
+def latest_positions(view_batch: ViewBatch) -> ViewBatch:
+    """Оставляет в батче по одной, самой поздней строке на пару
+    (user_id, film_id). При равном event_time побеждает строка, прочитанная
+    из Kafka позже.
+
+    Все события пары приходят в одну партицию (ключ сообщения -
+    user_id+film_id), поэтому строки сворачиваются внутри блоков
+    партиций. Блоки сохраняют диапазоны офсетов, и при повторной загрузке
+    тех же офсетов получаются те же строки и токены дедупликации.
+    """
+    result = ViewBatch()
+    event_time = view_batch.event_time
+    for block in view_batch.blocks:
+        latest: Dict[Tuple[str, str], int] = {}
+        keys = zip(
+            view_batch.user_id[block.start:block.stop],
+            view_batch.film_id[block.start:block.stop]
+        )
+        for index, key in enumerate(keys, block.start):
+            current = latest.get(key)
+            if current is None or event_time[index] >= event_time[current]:
+                latest[key] = index
+        indexes = sorted(latest.values())
+
+        start = len(result)
+        for column in ('user_id', 'film_id', 'start_time', 'end_time',
+                       'event_time'):
+            values = getattr(view_batch, column)
+            getattr(result, column).extend([values[i] for i in indexes])
+        result.blocks.append(block._replace(start=start, stop=len(result)))
+    return result
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Модули ETL импортируются из каталога src, как при запуске сервиса
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'src')
+)
@@ -0,0 +1,58 @@
+from uuid import uuid4
+
+import orjson
+import pytest
+from kafka.consumer.fetcher import ConsumerRecord
+
+from extract.decode import (POSITION_MAX, VIEW_SCHEMA_V1, VIEW_V1,
+                            decode_records)
+from extract.schema import ViewBatch
+
+
+def record(value: bytes, offset: int = 0) -> ConsumerRecord:
+    return ConsumerRecord(
+        'views', 0, offset, 0, 0, None, value, [], None,
+        -1, len(value), -1
+    )
+
+
+def json_view(start_time: int, end_time: int) -> bytes:
+    return orjson.dumps({
+        'user_id': str(uuid4()),
+        'film_id': str(uuid4()),
+        'start_time': start_time,
+        'end_time': end_time,
+        'timestamp': '2023-05-01T12:00:00',
+    })
+
+
+def binary_view(start_time: int, end_time: int) -> bytes:
+    return bytes((0, VIEW_SCHEMA_V1)) + VIEW_V1.pack(
+        uuid4().bytes, uuid4().bytes, start_time, end_time,
+        1682942400000
+    )
+
+
+@pytest.mark.parametrize('encode', [json_view, binary_view])
+@pytest.mark.parametrize('start_time, end_time, field', [
+    (-1, 10, 'start_time'),
+    (POSITION_MAX + 1, POSITION_MAX + 11, 'start_time'),
+    (0, POSITION_MAX + 1, 'end_time'),
+    (0, 2 ** 31 - 1, 'end_time'),
+])
+def test_position_out_of_uint16_range_is_invalid(
+        encode, start_time, end_time, field
+):
+    batch = ViewBatch()
+    records = [
+        record(encode(0, 10), 0),
+        record(encode(start_time, end_time), 1),
+        record(encode(POSITION_MAX - 10, POSITION_MAX), 2),
+    ]
+
+    invalid = decode_records(records, batch)
+
+    assert [bad.offset for bad, _ in invalid] == [1]
+    assert invalid[0][1].field == field
+    assert batch.start_time == [0, POSITION_MAX - 10]
+    assert batch.end_time == [10, POSITION_MAX]
@@ -8,6 +8,9 @@ cd src
 if [ "$USE_GUNICORN" = "true" ]
 then
 echo "Starting with GUNICORN"
+# Метрики воркеров gunicorn собираются через файлы общего каталога
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
 gunicorn $UVICORN_APP_NAME --workers $UVICORN_WORKERS --worker-class uvicorn.workers.UvicornWorker --bind $UVICORN_HOST:$UVICORN_PORT
 else
 echo "Starting without GUNICORN"
@@ -1,9 +1,11 @@
 from http import HTTPStatus
 from logging import getLogger
+from typing import List
 from uuid import UUID
 
 from async_fastapi_jwt_auth import AuthJWT
-from fastapi import APIRouter, Depends, HTTPException
+from core.config import settings
+from fastapi import APIRouter, Body, Depends, HTTPException
 from models.users_films import UserFilmTimestamp
 from pydantic import BaseModel
 from services.users_films import UserFilmService, get_userfilm_service
@@ -60,6 +62,49 @@ async def create_user_film_timestamp(
     return BaseResponse(detail='ok')
 
 
+@router.post('/batch',
+             summary='Пакетное создание временных меток о просмотренных пользователем частях кинопроизведений', # noqa
+             description='Пакетное создание временных меток, например накопленных плеером без сети. Все метки должны принадлежать пользователю из токена', # noqa
+             responses={
+                 HTTPStatus.OK: {
+                     'model': BaseResponse,
+                     'description': 'Результат операции'
+                 },
+                 HTTPStatus.BAD_REQUEST: {'model': HTTPError},
+                 HTTPStatus.FORBIDDEN: {'model': HTTPError}
+             })
+async def create_user_film_timestamps(
+        user_films_data: List[UserFilmTimestamp] = Body(
+            ...,
+            min_items=1,
+            max_items=settings.users_films_batch_max_size
+        ),
+        ugc_service: UserFilmService = Depends(get_userfilm_service),
+        Authorize: AuthJWT = Depends()
+):
+    await Authorize.jwt_required()
+    current_user = await Authorize.get_jwt_subject()
+    if any(
+        str(user_film_data.user_id) != current_user
+        for user_film_data in user_films_data
+    ):
+        logger.error('user_id в токене не соответсвует user_id в timestamp')
+        raise HTTPException(
+            status_code=HTTPStatus.FORBIDDEN,
+            detail="user_id в токене не соответсвует user_id в timestamp"
+        )
+    try:
+        await ugc_service.create_user_film_timestamps(user_films_data)
+    except Exception as exception:
+        logger.error(exception.__str__())
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=exception.__str__()
+        )
+
+    return BaseResponse(detail='ok')
+
+
 @router.get('/{user_id}/{film_id}/last_timestamp',
             summary='Получить последнюю временную метку просмотренной пользователем части кинопроизведения', # noqa
             description='Получить последнюю временную метку просмотренной пользователем части кинопроизведения', # noqa
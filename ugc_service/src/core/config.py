@@ -1,6 +1,7 @@
 import os
 from logging import config as logging_config
 from contextvars import ContextVar
+from typing import Literal
 
 from core.logger import LOGGING
 from pydantic import BaseSettings
@@ -24,10 +25,56 @@ class Settings(BaseSettings):
     kafka_host: str
     kafka_port: int
     kafka_view_topic: str
+    # binary - компактная бинарная схема (ETL принимает оба формата),
+    # json - прежний формат
+    kafka_view_encoding: Literal['json', 'binary'] = 'json'
+    # Продюсер копит сообщения в батчи до linger_ms и сжимает их
+    kafka_producer_linger_ms: int = 10
+    # gzip, snappy, lz4 или zstd (последним трем нужны свои библиотеки)
+    kafka_producer_compression: str | None = 'gzip'
+    kafka_producer_batch_size: int = 65536
+    kafka_producer_acks: Literal['0', '1', 'all'] = '1'
+    # Сообщений, ожидающих подтверждения брокера
+    kafka_producer_max_in_flight: int = 10000
+    # enqueued - ответ сразу после постановки в очередь продюсера,
+    # acked - после подтверждения брокера с уровнем acks
+    kafka_view_durability: Literal['enqueued', 'acked'] = 'enqueued'
+    # Буфер сообщений, которые продюсер не принял за enqueue_timeout
+    # секунд или не доставил: сначала в памяти, затем в сегменте на диске
+    # в каталоге kafka_buffer_dir. Используется только при
+    # kafka_view_durability=enqueued
+    kafka_buffer_enabled: bool = True
+    kafka_buffer_dir: str | None = None
+    kafka_buffer_memory_messages: int = 10000
+    kafka_buffer_disk_max_bytes: int = 256 * 1024 * 1024
+    kafka_buffer_enqueue_timeout: float = 0.5
+    kafka_buffer_retry_interval: float = 5
+    # Наибольшее число временных меток в одном запросе на пакетную запись
+    users_films_batch_max_size: int = 1000
+    # Окно, за которое от пары пользователь-фильм в Kafka уходит только
+    # последняя метка, 0 - отправлять каждую. Метка с перемоткой больше
+    # чем на coalesce_jump секунд отправляется сразу
+    users_films_coalesce_window: float = 0
+    users_films_coalesce_jump: int = 30
+    users_films_coalesce_max_keys: int = 100000
+    # Кэш последних позиций просмотра: memory - в памяти воркера
+    # (подходит для одного воркера), mongo - общий для воркеров,
+    # none - читать только из ClickHouse. Срок жизни записи должен
+    # перекрывать задержку доставки меток в ClickHouse
+    users_films_cache_backend: Literal['memory', 'mongo', 'none'] = 'memory'
+    users_films_cache_ttl: float = 3600
+    users_films_cache_max_keys: int = 100000
 
     # Настройки ClickHouse
     clickhouse_host: str
     clickhouse_port: str
+    # Пул соединений: запросы выполняются параллельно на разных
+    # соединениях, при max_size занятых запрос ждет acquire_timeout
+    # секунд
+    clickhouse_pool_min_size: int = 1
+    clickhouse_pool_max_size: int = 10
+    clickhouse_pool_acquire_timeout: float = 5
+    clickhouse_pool_health_check_interval: float = 30
 
     # Auth
     authjwt_secret_key: str
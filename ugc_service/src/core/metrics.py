@@ -0,0 +1,164 @@
+import os
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY,
+                               CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+
+# Под gunicorn у каждого воркера свои значения метрик. При заданной
+# PROMETHEUS_MULTIPROC_DIR они пишутся в файлы каталога и суммируются
+# при отдаче, иначе /metrics показывает только ответивший воркер
+MULTIPROCESS = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30)
+BATCH_RECORDS_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+KAFKA_SEND_LATENCY = Histogram(
+    'ugc_kafka_send_latency_seconds',
+    'Time from handing a message to the producer to the broker ack',
+    ['topic'],
+    buckets=LATENCY_BUCKETS
+)
+KAFKA_IN_FLIGHT_MESSAGES = Gauge(
+    'ugc_kafka_in_flight_messages',
+    'Messages handed to the producer and not yet acknowledged',
+    ['topic'],
+    multiprocess_mode='livesum'
+)
+KAFKA_QUEUED_WRITES = Gauge(
+    'ugc_kafka_queued_writes',
+    'Writes waiting for room in the producer in-flight limit',
+    multiprocess_mode='livesum'
+)
+KAFKA_SENT_MESSAGES = Counter(
+    'ugc_kafka_sent_messages',
+    'Messages acknowledged by the broker',
+    ['topic']
+)
+KAFKA_SEND_ERRORS = Counter(
+    'ugc_kafka_send_errors',
+    'Messages that failed to be delivered by error type',
+    ['topic', 'error']
+)
+KAFKA_BATCH_RECORDS = Histogram(
+    'ugc_kafka_batch_records',
+    'Messages per producer batch',
+    ['topic'],
+    buckets=BATCH_RECORDS_BUCKETS
+)
+KAFKA_BATCH_BYTES = Histogram(
+    'ugc_kafka_batch_bytes',
+    'Producer batch size on the wire, after compression',
+    ['topic'],
+    buckets=tuple(records * 64 for records in BATCH_RECORDS_BUCKETS)
+)
+KAFKA_COMPRESSION_RATIO = Histogram(
+    'ugc_kafka_compression_ratio',
+    'Uncompressed to compressed size of producer batches',
+    ['topic'],
+    buckets=(1, 1.25, 1.5, 2, 2.5, 3, 4, 5, 6, 8, 10)
+)
+KAFKA_RETRIES = Counter(
+    'ugc_kafka_retries',
+    'Producer batch resends',
+    ['topic']
+)
+
+KAFKA_BUFFER_MESSAGES = Gauge(
+    'ugc_kafka_buffer_messages',
+    'Messages waiting in the producer write-ahead buffer',
+    ['storage'],
+    multiprocess_mode='livesum'
+)
+KAFKA_BUFFER_DISK_BYTES = Gauge(
+    'ugc_kafka_buffer_disk_bytes',
+    'Size of the write-ahead buffer disk segment',
+    multiprocess_mode='livesum'
+)
+KAFKA_BUFFERED_MESSAGES = Counter(
+    'ugc_kafka_buffered_messages',
+    'Messages put into the write-ahead buffer instead of the producer'
+)
+KAFKA_BUFFER_DRAINED_MESSAGES = Counter(
+    'ugc_kafka_buffer_drained_messages',
+    'Messages delivered to Kafka from the write-ahead buffer'
+)
+KAFKA_BUFFER_REJECTED_MESSAGES = Counter(
+    'ugc_kafka_buffer_rejected_messages',
+    'Messages rejected because the write-ahead buffer is full'
+)
+KAFKA_PRODUCER_DEGRADED = Gauge(
+    'ugc_kafka_producer_degraded',
+    'Whether new messages go to the write-ahead buffer',
+    multiprocess_mode='livemax'
+)
+
+CLICKHOUSE_POOL_ACQUIRE_WAIT = Histogram(
+    'ugc_clickhouse_pool_acquire_wait_seconds',
+    'Time spent waiting for a free ClickHouse connection',
+    buckets=LATENCY_BUCKETS
+)
+CLICKHOUSE_POOL_ACQUIRE_TIMEOUTS = Counter(
+    'ugc_clickhouse_pool_acquire_timeouts',
+    'Requests that got no ClickHouse connection within the timeout'
+)
+CLICKHOUSE_POOL_CONNECTIONS = Gauge(
+    'ugc_clickhouse_pool_connections',
+    'Open ClickHouse connections by state',
+    ['state'],
+    multiprocess_mode='livesum'
+)
+CLICKHOUSE_POOL_CLOSED_CONNECTIONS = Counter(
+    'ugc_clickhouse_pool_closed_connections',
+    'ClickHouse connections closed by the pool by reason',
+    ['reason']
+)
+
+OLAP_QUERY_LATENCY = Histogram(
+    'ugc_olap_query_latency_seconds',
+    'ClickHouse query execution time by registered query',
+    ['query'],
+    buckets=LATENCY_BUCKETS
+)
+OLAP_QUERY_ROWS_READ = Histogram(
+    'ugc_olap_query_rows_read',
+    'Rows read by ClickHouse per query, from progress packets',
+    ['query'],
+    buckets=(0, 1, 10, 100, 1000, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7)
+)
+OLAP_QUERY_BYTES_READ = Histogram(
+    'ugc_olap_query_bytes_read',
+    'Bytes read by ClickHouse per query, from progress packets',
+    ['query'],
+    buckets=(0, 2 ** 10, 2 ** 14, 2 ** 17, 2 ** 20, 2 ** 23, 2 ** 26,
+             2 ** 30)
+)
+OLAP_QUERY_ERRORS = Counter(
+    'ugc_olap_query_errors',
+    'Failed ClickHouse queries by registered query',
+    ['query']
+)
+
+POSITION_CACHE_REQUESTS = Counter(
+    'ugc_position_cache_requests',
+    'Last position reads by cache result',
+    ['result']
+)
+POSITION_CACHE_ERRORS = Counter(
+    'ugc_position_cache_errors',
+    'Failed position cache operations',
+    ['operation']
+)
+
+
+def latest() -> bytes:
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+def mark_process_dead(pid: int) -> None:
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,276 @@
+import fcntl
+import logging
+import os
+import struct
+from collections import deque
+from itertools import islice
+from typing import BinaryIO, Deque, List, Optional, Tuple
+
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+# topic, key, value
+Message = Tuple[str, str, bytes]
+
+# Длины темы, ключа и значения
+RECORD_HEADER = struct.Struct('<HHI')
+
+
+class BufferFull(Exception):
+    pass
+
+
+class WriteAheadBuffer:
+    """Очередь сообщений, которые не удалось сразу передать продюсеру.
+
+    Сообщения сначала копятся в памяти, после memory_max_messages -
+    в сегменте на диске. Пока в сегменте есть сообщения, новые тоже
+    пишутся в него, поэтому сообщения из памяти всегда старше дисковых
+    и очередь отдает их в порядке записи. Сегмент переживает перезапуск:
+    прочитанная часть отмечается в файле .pos, при закрытии содержимое
+    памяти переносится в сегмент.
+
+    Каждому процессу достается свой сегмент: path/segment-N с первым
+    свободным N, занятость отмечается блокировкой файла .lock. При
+    открытии в свой сегмент переносятся сообщения сегментов, которые не
+    занял ни один процесс, например после уменьшения числа воркеров.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str],
+        memory_max_messages: int,
+        disk_max_bytes: int
+    ) -> None:
+        self.memory_max_messages = memory_max_messages
+        self.disk_max_bytes = disk_max_bytes
+        self._memory: Deque[Message] = deque()
+        self._segment: Optional[str] = None
+        self._lock: Optional[BinaryIO] = None
+        self._file: Optional[BinaryIO] = None
+        self._read_pos = 0
+        self._size = 0
+        self._disk_messages = 0
+        # Конец сообщений, отданных последним peek с диска
+        self._peek_end = 0
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self._open_segment(path)
+        self._report()
+
+    def __len__(self) -> int:
+        return len(self._memory) + self._disk_messages
+
+    def append(self, message: Message) -> None:
+        to_memory = len(self._memory) < self.memory_max_messages
+        if not self._disk_messages and to_memory:
+            self._memory.append(message)
+        elif self._file and self._size < self.disk_max_bytes:
+            self._write(self._file, message)
+            self._file.flush()
+        else:
+            metrics.KAFKA_BUFFER_REJECTED_MESSAGES.inc()
+            raise BufferFull('Буфер сообщений Kafka переполнен')
+        metrics.KAFKA_BUFFERED_MESSAGES.inc()
+        self._report()
+
+    def peek(self, count: int) -> List[Message]:
+        """Самые старые сообщения, остаются в буфере до remove."""
+        if self._memory:
+            return list(islice(self._memory, count))
+        if not self._disk_messages:
+            return []
+        path, file = self._disk()
+        file.flush()
+        messages: List[Message] = []
+        with open(path, 'rb') as segment:
+            segment.seek(self._read_pos)
+            while len(messages) < count:
+                message = self._read(segment)
+                if message is None:
+                    break
+                messages.append(message)
+            self._peek_end = segment.tell()
+        return messages
+
+    def remove(self, count: int) -> None:
+        """Убирает count сообщений, отданных последним peek."""
+        if self._memory:
+            for _ in range(count):
+                self._memory.popleft()
+        elif count:
+            self._disk_messages -= count
+            self._read_pos = self._peek_end
+            if not self._disk_messages:
+                self._truncate()
+            else:
+                self._save_position()
+        self._report()
+
+    def close(self) -> None:
+        if self._file:
+            if self._memory:
+                self._spill_memory()
+            self._file.close()
+            self._file = None
+        if self._lock:
+            self._lock.close()
+            self._lock = None
+        if self._memory:
+            logger.error(
+                'Сообщения Kafka из буфера в памяти потеряны: %s',
+                len(self._memory)
+            )
+
+    def _open_segment(self, path: str) -> None:
+        number = 0
+        while True:
+            lock = open(os.path.join(path, f'segment-{number}.lock'), 'wb')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                lock.close()
+                number += 1
+        self._lock = lock
+        segment = self._segment = os.path.join(path, f'segment-{number}')
+        self._read_pos = self._load_position(segment)
+        file = self._file = open(segment, 'ab')
+        self._count_messages(segment, file)
+        if self._disk_messages:
+            logger.info(
+                'Kafka buffer segment %s: %s messages left from the '
+                'previous run', segment, self._disk_messages
+            )
+        self._merge_orphans(path, segment, file)
+
+    def _disk(self) -> Tuple[str, BinaryIO]:
+        if self._segment is None or self._file is None:
+            raise RuntimeError('Буфер сообщений Kafka без сегмента на диске')
+        return self._segment, self._file
+
+    @staticmethod
+    def _load_position(segment: str) -> int:
+        try:
+            with open(f'{segment}.pos') as position:
+                read_pos = int(position.read() or 0)
+        except FileNotFoundError:
+            return 0
+        if not os.path.exists(segment):
+            return 0
+        return read_pos if read_pos <= os.path.getsize(segment) else 0
+
+    def _count_messages(self, path: str, file: BinaryIO) -> None:
+        """Считает сообщения сегмента и отрезает недописанное при сбое."""
+        end = self._read_pos
+        with open(path, 'rb') as segment:
+            segment.seek(end)
+            while self._read(segment) is not None:
+                self._disk_messages += 1
+                end = segment.tell()
+        if end < os.path.getsize(path):
+            logger.warning(
+                'Сегмент %s обрезан до последнего целого сообщения', path
+            )
+            file.truncate(end)
+        self._size = end
+        if not self._disk_messages:
+            self._truncate()
+
+    def _merge_orphans(self, path: str, own: str, file: BinaryIO) -> None:
+        """Дописывает в свой сегмент непрочитанные сообщения сегментов,
+        блокировку которых удалось взять, и удаляет их. Сбой до удаления
+        повторит сообщения, как и сбой при отправке из буфера."""
+        for name in sorted(os.listdir(path)):
+            orphan = os.path.join(path, name)
+            number = name[len('segment-'):]
+            if not name.startswith('segment-') or not number.isdigit():
+                continue
+            if orphan == own:
+                continue
+            with open(f'{orphan}.lock', 'wb') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                read_pos = self._load_position(orphan)
+                merged = 0
+                with open(orphan, 'rb') as segment:
+                    segment.seek(read_pos)
+                    while (message := self._read(segment)) is not None:
+                        self._write(file, message)
+                        merged += 1
+                file.flush()
+                os.fsync(file.fileno())
+                os.remove(orphan)
+                if os.path.exists(f'{orphan}.pos'):
+                    os.remove(f'{orphan}.pos')
+            if merged:
+                logger.info(
+                    'Kafka buffer segment %s merged into %s: %s messages',
+                    orphan, own, merged
+                )
+
+    def _write(self, file: BinaryIO, message: Message) -> None:
+        topic, key, value = message
+        topic_bytes = topic.encode()
+        key_bytes = key.encode()
+        record = RECORD_HEADER.pack(
+            len(topic_bytes), len(key_bytes), len(value)
+        ) + topic_bytes + key_bytes + value
+        file.write(record)
+        self._size += len(record)
+        self._disk_messages += 1
+
+    @staticmethod
+    def _read(segment: BinaryIO) -> Optional[Message]:
+        header = segment.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return None
+        topic_size, key_size, value_size = RECORD_HEADER.unpack(header)
+        body = segment.read(topic_size + key_size + value_size)
+        if len(body) < topic_size + key_size + value_size:
+            return None
+        return (
+            body[:topic_size].decode(),
+            body[topic_size:topic_size + key_size].decode(),
+            body[topic_size + key_size:]
+        )
+
+    def _truncate(self) -> None:
+        _, file = self._disk()
+        file.truncate(0)
+        file.seek(0)
+        self._read_pos = self._peek_end = self._size = 0
+        self._save_position()
+
+    def _save_position(self) -> None:
+        with open(f'{self._segment}.pos', 'w') as position:
+            position.write(str(self._read_pos))
+
+    def _spill_memory(self) -> None:
+        """Переносит сообщения из памяти в начало непрочитанной части
+        сегмента, чтобы после перезапуска они ушли первыми."""
+        path, file = self._disk()
+        file.flush()
+        spilled = f'{path}.new'
+        with open(spilled, 'wb') as new_segment:
+            for message in self._memory:
+                self._write(new_segment, message)
+            with open(path, 'rb') as segment:
+                segment.seek(self._read_pos)
+                while chunk := segment.read(1 << 20):
+                    new_segment.write(chunk)
+            new_segment.flush()
+            os.fsync(new_segment.fileno())
+        os.replace(spilled, path)
+        self._read_pos = 0
+        self._save_position()
+        self._memory.clear()
+
+    def _report(self) -> None:
+        metrics.KAFKA_BUFFER_MESSAGES.labels('memory').set(len(self._memory))
+        metrics.KAFKA_BUFFER_MESSAGES.labels('disk').set(self._disk_messages)
+        metrics.KAFKA_BUFFER_DISK_BYTES.set(self._size - self._read_pos)
+        metrics.KAFKA_PRODUCER_DEGRADED.set(1 if len(self) else 0)
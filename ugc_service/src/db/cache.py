@@ -0,0 +1,191 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from time import monotonic
+from typing import Dict, Iterable, List, Optional, Tuple
+from uuid import UUID
+
+from models.users_films import UserFilmTimestamp
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+# Код ошибки MongoDB при вставке документа с существующим _id
+DUPLICATE_KEY = 11000
+
+
+def event_time(user_film_data: UserFilmTimestamp) -> datetime:
+    """Время события без часового пояса, как его сохраняет ETL."""
+    return user_film_data.timestamp.replace(tzinfo=None)
+
+
+def latest_by_key(
+    user_films_data: Iterable[UserFilmTimestamp]
+) -> Dict[Tuple[UUID, UUID], UserFilmTimestamp]:
+    """По одной, самой поздней метке на пару (user_id, film_id)."""
+    latest: Dict[Tuple[UUID, UUID], UserFilmTimestamp] = {}
+    for user_film_data in user_films_data:
+        key = (user_film_data.user_id, user_film_data.film_id)
+        current = latest.get(key)
+        if current is None or event_time(user_film_data) >= event_time(
+            current
+        ):
+            latest[key] = user_film_data
+    return latest
+
+
+class GenericPositionCache(ABC):
+    """Последние позиции просмотра пар (user_id, film_id).
+
+    Метка заменяет сохраненную, только если она не старее: запись из
+    ClickHouse, прочитанная до прихода новой метки, не затирает ее.
+    """
+
+    async def connect(self) -> None:
+        pass
+
+    @abstractmethod
+    async def get(
+        self,
+        user_id: UUID,
+        film_id: UUID
+    ) -> Optional[UserFilmTimestamp]:
+        pass
+
+    @abstractmethod
+    async def put_many(
+        self,
+        user_films_data: List[UserFilmTimestamp]
+    ) -> None:
+        pass
+
+
+class MemoryPositionCache(GenericPositionCache):
+    """Кэш в памяти процесса с вытеснением давно не использованных пар.
+
+    У каждого воркера gunicorn свой кэш, и воркер может отдать позицию,
+    которую уже обновил другой воркер, поэтому кэш подходит для одного
+    воркера и тестов.
+    """
+
+    def __init__(self, ttl: float, max_keys: int) -> None:
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._items: OrderedDict[
+            Tuple[UUID, UUID], Tuple[float, UserFilmTimestamp]
+        ] = OrderedDict()
+
+    async def get(
+        self,
+        user_id: UUID,
+        film_id: UUID
+    ) -> Optional[UserFilmTimestamp]:
+        key = (user_id, film_id)
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires_at, user_film_data = item
+        if expires_at <= monotonic():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return user_film_data
+
+    async def put_many(
+        self,
+        user_films_data: List[UserFilmTimestamp]
+    ) -> None:
+        expires_at = monotonic() + self.ttl
+        items = self._items
+        for key, user_film_data in latest_by_key(user_films_data).items():
+            current = items.get(key)
+            if current is not None and event_time(current[1]) > event_time(
+                user_film_data
+            ):
+                continue
+            items[key] = (expires_at, user_film_data)
+            items.move_to_end(key)
+        while len(items) > self.max_keys:
+            items.popitem(last=False)
+
+
+class MongoPositionCache(GenericPositionCache):
+    """Кэш в коллекции MongoDB, общий для всех воркеров.
+
+    Просроченные документы удаляет TTL-индекс, но он срабатывает раз в
+    минуту, поэтому срок проверяется и при чтении.
+    """
+
+    def __init__(
+        self,
+        mongo_client: AsyncIOMotorClient,
+        ttl: float
+    ) -> None:
+        self._positions = mongo_client.cache.view_positions
+        self.ttl = timedelta(seconds=ttl)
+
+    async def connect(self) -> None:
+        await self._positions.create_index(
+            'expires_at', expireAfterSeconds=0
+        )
+
+    async def get(
+        self,
+        user_id: UUID,
+        film_id: UUID
+    ) -> Optional[UserFilmTimestamp]:
+        document = await self._positions.find_one({
+            '_id': f'{user_id}+{film_id}',
+            'expires_at': {'$gt': datetime.utcnow()},
+        })
+        if document is None:
+            return None
+        return UserFilmTimestamp(
+            user_id=user_id,
+            film_id=film_id,
+            start_time=document['start_time'],
+            end_time=document['end_time'],
+            timestamp=document['timestamp']
+        )
+
+    async def put_many(
+        self,
+        user_films_data: List[UserFilmTimestamp]
+    ) -> None:
+        expires_at = datetime.utcnow() + self.ttl
+        requests = []
+        for user_film_data in latest_by_key(user_films_data).values():
+            timestamp = event_time(user_film_data)
+            # Если сохранена более поздняя метка, фильтр не находит
+            # документ, и upsert падает на существующем _id
+            requests.append(UpdateOne(
+                {
+                    '_id': (f'{user_film_data.user_id}'
+                            f'+{user_film_data.film_id}'),
+                    'timestamp': {'$lte': timestamp},
+                },
+                {'$set': {
+                    'start_time': user_film_data.start_time,
+                    'end_time': user_film_data.end_time,
+                    'timestamp': timestamp,
+                    'expires_at': expires_at,
+                }},
+                upsert=True
+            ))
+        if not requests:
+            return
+        try:
+            await self._positions.bulk_write(requests, ordered=False)
+        except BulkWriteError as error:
+            if any(
+                write_error['code'] != DUPLICATE_KEY
+                for write_error in error.details['writeErrors']
+            ) or error.details.get('writeConcernErrors'):
+                raise
+
+
+position_cache: Optional[GenericPositionCache] = None
+
+
+async def get_position_cache() -> Optional[GenericPositionCache]:
+    return position_cache
@@ -1,13 +1,77 @@
 from abc import ABC, abstractmethod
-from typing import Optional
+from datetime import date, datetime
+from textwrap import dedent
+from time import monotonic
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 from uuid import UUID
 
 import backoff
-from asynch import connect
 from asynch.cursors import DictCursor
+from core import metrics
 from core.config import settings
+from db.pool import ConnectionPool, PoolTimeout
 from models.users_films import UserFilmTimestamp
 
+# Типы, которые asynch экранирует при подстановке. Значения прочих
+# типов он вставляет в текст запроса как есть
+PARAM_TYPES = (str, int, float, date, datetime, UUID, list, tuple)
+
+
+class Query(NamedTuple):
+    """Запрос с именованными параметрами %(name)s и их типами."""
+    name: str
+    sql: str
+    params: Dict[str, type]
+
+    def bind(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        if values.keys() != self.params.keys():
+            raise ValueError(
+                f'Запрос {self.name} ожидает параметры '
+                f'{sorted(self.params)}, получены {sorted(values)}'
+            )
+        for name, value in values.items():
+            if not isinstance(value, self.params[name]):
+                raise TypeError(
+                    f'Параметр {name} запроса {self.name} должен быть '
+                    f'{self.params[name].__name__}, получен '
+                    f'{type(value).__name__}'
+                )
+        return values
+
+
+QUERIES: Dict[str, Query] = {}
+
+
+def register_query(name: str, sql: str, **params: type) -> Query:
+    if name in QUERIES:
+        raise ValueError(f'Запрос {name} уже зарегистрирован')
+    for param, param_type in params.items():
+        if not issubclass(param_type, PARAM_TYPES):
+            raise TypeError(
+                f'Тип {param_type.__name__} параметра {param} '
+                'не экранируется драйвером'
+            )
+    query = Query(name, dedent(sql).strip(), params)
+    QUERIES[name] = query
+    return query
+
+
+# argMaxMerge объединяет состояния из кусков, которые еще не слились.
+# Шард вычисляется по ключу шардирования CRC32(user_id), остальные шарды
+# не опрашиваются
+LAST_USER_FILM_POSITION = register_query(
+    'last_user_film_position',
+    """
+    SELECT argMaxMerge(position) AS position
+    FROM default.view_position
+    WHERE user_id = %(user_id)s AND film_id = %(film_id)s
+    GROUP BY user_id, film_id
+    SETTINGS optimize_skip_unused_shards = 1
+    """,
+    user_id=UUID,
+    film_id=UUID
+)
+
 
 class GenericOlap(ABC):
     pass
@@ -22,10 +86,26 @@ class GenericOlap(ABC):
 
 
 class ClickHouseOlap(GenericOlap):
-    def __init__(self, host: str, port: str) -> None:
+    def __init__(
+        self,
+        host: str,
+        port: str,
+        pool_min_size: int = 1,
+        pool_max_size: int = 10,
+        acquire_timeout: float = 5,
+        health_check_interval: float = 30
+    ) -> None:
         self.host = host
         self.port = port
-        self._connect = None
+        self._pool = ConnectionPool(
+            pool_min_size,
+            pool_max_size,
+            acquire_timeout,
+            health_check_interval,
+            host=host,
+            port=port
+        )
+        self._connected = False
 
     @backoff.on_exception(
         backoff.expo,
@@ -33,38 +113,81 @@ class ClickHouseOlap(GenericOlap):
         max_time=settings.backoff_max_time
     )
     async def connect(self) -> None:
-        self._connect = await connect(
-            host=self.host,
-            port=self.port,
-        )
+        await self._pool.open()
+        self._connected = True
+
+    async def disconnect(self) -> None:
+        self._connected = False
+        await self._pool.close()
 
+    # Повтор при исчерпании пула только добавил бы ожидающих, а ошибки
+    # параметров запроса повтор не исправит
     @backoff.on_exception(
         backoff.expo,
         Exception,
-        max_time=settings.backoff_max_time
+        max_time=settings.backoff_max_time,
+        giveup=lambda exception: isinstance(
+            exception, (PoolTimeout, TypeError, ValueError)
+        )
     )
     async def get_last_user_film_timestamp(
         self,
         user_id: UUID,
         film_id: UUID
     ) -> UserFilmTimestamp:
-        if self._connect:
-            async with self._connect.cursor(cursor=DictCursor) as cursor:
-                count = await cursor.execute("""
-                    SELECT * FROM default.view
-                    WHERE (user_id=='{user_id}') AND (film_id=='{film_id}')
-                    ORDER BY event_time DESC LIMIT 1
-                """.format(user_id=user_id, film_id=film_id))
-                if not count:
-                    return None
-                result = await cursor.fetchone()
-                return UserFilmTimestamp(
-                    user_id=result['user_id'],
-                    film_id=result['film_id'],
-                    start_time=result['start_time'],
-                    end_time=result['end_time'],
-                    timestamp=result['event_time']
-                )
+        if not self._connected:
+            return None
+        rows = await self.fetch(
+            LAST_USER_FILM_POSITION, user_id=user_id, film_id=film_id
+        )
+        if not rows:
+            return None
+        start_time, end_time, event_time = rows[0]['position']
+        return UserFilmTimestamp(
+            user_id=user_id,
+            film_id=film_id,
+            start_time=start_time,
+            end_time=end_time,
+            timestamp=event_time
+        )
+
+    async def fetch(self, query: Query, **values: Any) -> List[dict]:
+        """Строки результата запроса из реестра.
+
+        Время выполнения и прочитанные сервером строки и байты (из
+        пакетов прогресса ClickHouse) пишутся в метрики с именем запроса.
+        """
+        params = query.bind(values)
+        async with self._pool.acquire() as connection:
+            # Курсор не закрывается: в asynch это закрывает и соединение
+            cursor = connection.cursor(cursor=DictCursor)
+            started_at = monotonic()
+            try:
+                await cursor.execute(query.sql, params)
+            except Exception:
+                metrics.OLAP_QUERY_ERRORS.labels(query.name).inc()
+                raise
+            metrics.OLAP_QUERY_LATENCY.labels(query.name).observe(
+                monotonic() - started_at
+            )
+            rows_read, bytes_read = read_progress(connection)
+            metrics.OLAP_QUERY_ROWS_READ.labels(query.name).observe(rows_read)
+            metrics.OLAP_QUERY_BYTES_READ.labels(query.name).observe(
+                bytes_read
+            )
+            return await cursor.fetchall()
+
+
+def read_progress(connection) -> Tuple[int, int]:
+    """Строки и байты, прочитанные сервером за последний запрос.
+
+    Курсор asynch прогресс не отдает, он накапливается в соединении
+    протокола.
+    """
+    last_query = connection._connection.last_query
+    if last_query is None or last_query.progress is None:
+        return 0, 0
+    return last_query.progress.rows, last_query.progress.bytes
 
 
 olap_bd: Optional[GenericOlap] = None
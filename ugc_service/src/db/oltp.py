@@ -1,14 +1,69 @@
+import asyncio
 import logging
 from abc import ABC, abstractmethod
 from logging.config import dictConfig
-from typing import Optional
+from time import monotonic
+from typing import List, Literal, Optional, Tuple
 
 from aiokafka import AIOKafkaProducer
+from aiokafka.errors import KafkaError
+from core import metrics
 from core.logger import LOGGING
+from db.buffer import BufferFull, WriteAheadBuffer
 
 logger = logging.getLogger(__name__)
 dictConfig(LOGGING)
 
+# enqueued - запись возвращается, как только сообщение встало в очередь
+# продюсера, acked - после подтверждения брокера с уровнем acks
+Durability = Literal['enqueued', 'acked']
+
+
+def instrument_batches(producer: AIOKafkaProducer) -> None:
+    """Метрики батчей продюсера: число сообщений, размер, сжатие
+    и повторы отправки.
+
+    У aiokafka нет открытого API метрик, поэтому перехватывается
+    выборка батчей из аккумулятора перед отправкой. Зависит от версии
+    aiokafka: при другом устройстве аккумулятора метрики батчей
+    не собираются.
+    """
+    try:
+        accumulator = producer._message_accumulator
+        drain_by_nodes = accumulator.drain_by_nodes
+    except AttributeError:
+        logger.warning('Метрики батчей Kafka недоступны для этой aiokafka')
+        return
+
+    def observe(batch, uncompressed: int, future: asyncio.Future) -> None:
+        topic = batch.tp.topic
+        compressed = batch._builder.size()
+        metrics.KAFKA_BATCH_RECORDS.labels(topic).observe(batch.record_count)
+        metrics.KAFKA_BATCH_BYTES.labels(topic).observe(compressed)
+        if compressed:
+            metrics.KAFKA_COMPRESSION_RATIO.labels(topic).observe(
+                uncompressed / compressed
+            )
+        if batch.retry_count > 1:
+            metrics.KAFKA_RETRIES.labels(topic).inc(batch.retry_count - 1)
+
+    def drain_instrumented(*args, **kwargs):
+        nodes, unknown_leaders_exist = drain_by_nodes(*args, **kwargs)
+        for batches in nodes.values():
+            for batch in batches.values():
+                # Повторно отправляемый батч уже учтен
+                if batch.retry_count != 1:
+                    continue
+                # До отправки батч еще не сжат
+                uncompressed = batch._builder.size()
+                batch.future.add_done_callback(
+                    lambda future, batch=batch, size=uncompressed:
+                        observe(batch, size, future)
+                )
+        return nodes, unknown_leaders_exist
+
+    accumulator.drain_by_nodes = drain_instrumented
+
 
 class GenericOltp(ABC):
 
@@ -21,29 +76,266 @@ class GenericOltp(ABC):
         pass
 
     @abstractmethod
-    async def write(self, key, data, topic):
+    async def write(self, key, data, topic, durability=None):
+        pass
+
+    @abstractmethod
+    async def write_batch(self, messages, topic, durability=None):
         pass
 
 
 class KafkaOltp(GenericOltp):
-    def __init__(self, bootstrap_servers: list) -> None:
+    """Продюсер копит сообщения в батчи до linger_ms и сжимает их.
+
+    Число сообщений, отправленных, но еще не подтвержденных брокером,
+    ограничено max_in_flight: при переполнении запись ждет освобождения
+    места. Ошибки доставки сообщений, за подтверждением которых никто
+    не ждет, пишутся в лог.
+
+    С буфером сообщения без ожидания подтверждения, которые продюсер
+    не принял за enqueue_timeout или не доставил, а также все следующие
+    за ними пишутся в буфер. Фоновая задача отправляет их по порядку,
+    пока буфер не опустеет. Доставка из буфера - не менее одного раза.
+    Порядок сохраняется не всегда: сообщение, которое продюсер принял,
+    но не доставил, попадает в буфер после более новых сообщений.
+    """
+
+    # Сообщений из буфера в одной попытке отправки
+    DRAIN_CHUNK = 500
+
+    def __init__(
+        self,
+        bootstrap_servers: list,
+        linger_ms: int = 0,
+        compression_type: Optional[str] = None,
+        max_batch_size: int = 16384,
+        acks: str = '1',
+        max_in_flight: int = 10000,
+        durability: Durability = 'acked',
+        buffer: Optional[WriteAheadBuffer] = None,
+        enqueue_timeout: float = 0.5,
+        retry_interval: float = 5
+    ) -> None:
         self.bootstrap_servers = bootstrap_servers
+        self.linger_ms = linger_ms
+        self.compression_type = compression_type
+        self.max_batch_size = max_batch_size
+        self.acks = int(acks) if acks.isdigit() else acks
+        self.max_in_flight = max_in_flight
+        self.durability = durability
+        self.buffer = buffer
+        self.enqueue_timeout = enqueue_timeout
+        self.retry_interval = retry_interval
+        self.failed = 0
+        self._drain_task: Optional[asyncio.Task] = None
 
     async def connect(self) -> None:
         self.producer = AIOKafkaProducer(
-            bootstrap_servers=self.bootstrap_servers
+            bootstrap_servers=self.bootstrap_servers,
+            linger_ms=self.linger_ms,
+            compression_type=self.compression_type,
+            max_batch_size=self.max_batch_size,
+            acks=self.acks
         )
+        instrument_batches(self.producer)
+        self._in_flight = asyncio.Semaphore(self.max_in_flight)
         await self.producer.start()
+        if self.buffer is not None:
+            self._drain_task = asyncio.create_task(self._drain())
 
     async def disconnect(self) -> None:
+        if self._drain_task:
+            self._drain_task.cancel()
+            await asyncio.gather(self._drain_task, return_exceptions=True)
+        # stop отправляет накопленные батчи
         await self.producer.stop()
+        if self.buffer is not None:
+            self.buffer.close()
+
+    async def write(
+        self,
+        key: str,
+        data: str | bytes,
+        topic: str,
+        durability: Optional[Durability] = None
+    ):
+        await self.write_batch([(key, data)], topic, durability)
+
+    async def write_batch(
+        self,
+        messages: List[Tuple[str, str | bytes]],
+        topic: str,
+        durability: Optional[Durability] = None
+    ):
+        """Сообщения попадают в батчи продюсера по партициям ключей
+        и уходят в Kafka общими запросами."""
+        acked = (durability or self.durability) == 'acked'
+        # Тем, кто ждет подтверждения брокера, буфер не поможет
+        buffered = self.buffer is not None and not acked
+        deliveries = []
+        for key, data in messages:
+            delivery = await self._enqueue(key, data, topic, buffered)
+            if delivery:
+                deliveries.append(delivery)
+        if acked:
+            await asyncio.shield(asyncio.gather(*deliveries))
 
-    async def write(self, key: str, data: str, topic: str):
-        await self.producer.send_and_wait(
-            topic=topic,
-            value=bytes(data, encoding='utf-8'),
-            key=bytes(key, encoding='utf-8')
+    async def _enqueue(
+        self,
+        key: str,
+        data: str | bytes,
+        topic: str,
+        buffered: bool
+    ) -> Optional[asyncio.Future]:
+        """Возвращает None, если сообщение записано в буфер."""
+        if isinstance(data, str):
+            data = data.encode()
+        buffer = self.buffer if buffered else None
+        if buffer is not None and (buffer or self._in_flight.locked()):
+            buffer.append((topic, key, data))
+            return None
+        metrics.KAFKA_QUEUED_WRITES.inc()
+        try:
+            await self._in_flight.acquire()
+        finally:
+            metrics.KAFKA_QUEUED_WRITES.dec()
+        started_at = monotonic()
+        try:
+            send = self.producer.send(
+                topic=topic,
+                value=data,
+                key=key.encode()
+            )
+            if buffer is not None:
+                delivery = await asyncio.wait_for(send, self.enqueue_timeout)
+            else:
+                delivery = await send
+        except (KafkaError, asyncio.TimeoutError) as error:
+            self._in_flight.release()
+            metrics.KAFKA_SEND_ERRORS.labels(
+                topic, type(error).__name__
+            ).inc()
+            if buffer is None:
+                raise
+            logger.warning(
+                'Продюсер Kafka не принял сообщение, запись в буфер: %r',
+                error
+            )
+            buffer.append((topic, key, data))
+            return None
+        except BaseException:
+            self._in_flight.release()
+            raise
+        metrics.KAFKA_IN_FLIGHT_MESSAGES.labels(topic).inc()
+        delivery.add_done_callback(
+            lambda future: self._delivered(
+                future, topic, key, data if buffer is not None else None,
+                started_at
+            )
         )
+        return delivery
+
+    def _delivered(
+        self,
+        future: asyncio.Future,
+        topic: str,
+        key: str,
+        data: Optional[bytes],
+        started_at: float
+    ):
+        """data передается, если недоставленное сообщение нужно
+        сохранить в буфере. Оно встает в конец буфера, за сообщениями,
+        отправленными позже него."""
+        self._in_flight.release()
+        metrics.KAFKA_IN_FLIGHT_MESSAGES.labels(topic).dec()
+        error = self._observe_delivery(future, topic, started_at)
+        if not error:
+            return
+        if data is not None and self.buffer is not None:
+            try:
+                self.buffer.append((topic, key, data))
+                return
+            except BufferFull:
+                pass
+        self.failed += 1
+        logger.error(
+            'Сообщение не доставлено в Kafka, topic=%s, key=%s: %s',
+            topic, key, error
+        )
+
+    @staticmethod
+    def _observe_delivery(
+        future: asyncio.Future,
+        topic: str,
+        started_at: float
+    ) -> Optional[BaseException]:
+        """Метрики доставки сообщения, возвращает ошибку доставки."""
+        if future.cancelled():
+            return None
+        error = future.exception()
+        if not error:
+            metrics.KAFKA_SENT_MESSAGES.labels(topic).inc()
+            metrics.KAFKA_SEND_LATENCY.labels(topic).observe(
+                monotonic() - started_at
+            )
+            return None
+        metrics.KAFKA_SEND_ERRORS.labels(topic, type(error).__name__).inc()
+        return error
+
+    async def _drain(self) -> None:
+        buffer = self.buffer
+        if buffer is None:
+            return
+        while True:
+            if not buffer:
+                await asyncio.sleep(0.1)
+                continue
+            try:
+                await self._drain_chunk(buffer)
+            except (KafkaError, asyncio.TimeoutError) as error:
+                logger.warning(
+                    'Kafka недоступна, в буфере %s сообщений: %r',
+                    len(buffer), error
+                )
+                await asyncio.sleep(self.retry_interval)
+            except Exception:
+                # Например, ошибка чтения сегмента: задача не должна
+                # завершаться, иначе буфер перестанет отправляться
+                logger.exception(
+                    'Ошибка отправки сообщений из буфера Kafka, в буфере '
+                    '%s сообщений', len(buffer)
+                )
+                await asyncio.sleep(self.retry_interval)
+
+    async def _drain_chunk(self, buffer: WriteAheadBuffer) -> None:
+        messages = buffer.peek(self.DRAIN_CHUNK)
+        deliveries = []
+        for topic, key, data in messages:
+            started_at = monotonic()
+            try:
+                delivery = await asyncio.wait_for(
+                    self.producer.send(
+                        topic=topic,
+                        value=data,
+                        key=key.encode()
+                    ),
+                    self.enqueue_timeout
+                )
+            except (KafkaError, asyncio.TimeoutError) as error:
+                metrics.KAFKA_SEND_ERRORS.labels(
+                    topic, type(error).__name__
+                ).inc()
+                raise
+            delivery.add_done_callback(
+                lambda future, topic=topic, started_at=started_at:
+                    self._observe_delivery(future, topic, started_at)
+            )
+            deliveries.append(delivery)
+        await asyncio.gather(*deliveries)
+        buffer.remove(len(messages))
+        metrics.KAFKA_BUFFER_DRAINED_MESSAGES.inc(len(messages))
+        if not buffer:
+            logger.info('Kafka write-ahead buffer drained')
 
 
 oltp_bd: Optional[GenericOltp] = None
@@ -0,0 +1,179 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from time import monotonic
+from typing import AsyncIterator, List, Optional, Tuple
+
+from asynch import connect
+from asynch.connection import Connection
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Пул соединений asynch с ClickHouse.
+
+    Соединение ClickHouse выполняет один запрос за раз, поэтому
+    параллельные запросы получают разные соединения: пул держит от
+    min_size свободных соединений и открывает новые по требованию, пока
+    занятых меньше max_size, иначе запрос ждет до acquire_timeout секунд.
+
+    Соединение, на котором запрос завершился ошибкой или был отменен,
+    закрывается: отмененный запрос оставляет его в состоянии выполнения.
+    Раз в health_check_interval секунд свободные соединения сверх min_size,
+    простоявшие весь интервал, закрываются, остальные проверяются запросом
+    SELECT 1 (asynch при этом переподключает оборванное соединение), и
+    пул снова дополняется до min_size. Проверяемое соединение считается
+    занятым и входит в max_size.
+    """
+
+    def __init__(
+        self,
+        min_size: int,
+        max_size: int,
+        acquire_timeout: float,
+        health_check_interval: float,
+        **connection_kwargs
+    ) -> None:
+        if not 0 <= min_size <= max_size:
+            raise ValueError('Ожидается 0 <= min_size <= max_size')
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+        self.connection_kwargs = connection_kwargs
+        self._slots = asyncio.Semaphore(max_size)
+        # Свободные соединения со временем возврата в пул. Запросы берут
+        # последнее возвращенное, лишние соединения простаивают
+        self._free: List[Tuple[Connection, float]] = []
+        self._used = 0
+        self._health_task: Optional[asyncio.Task] = None
+
+    async def open(self) -> None:
+        await self._fill()
+        self._health_task = asyncio.get_running_loop().create_task(
+            self._check_health()
+        )
+
+    async def close(self) -> None:
+        if self._health_task:
+            self._health_task.cancel()
+            self._health_task = None
+        free, self._free = self._free, []
+        for connection, _ in free:
+            await self._discard(connection, None)
+        self._report()
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[Connection]:
+        started_at = monotonic()
+        try:
+            await asyncio.wait_for(
+                self._slots.acquire(), self.acquire_timeout
+            )
+        except asyncio.TimeoutError:
+            metrics.CLICKHOUSE_POOL_ACQUIRE_TIMEOUTS.inc()
+            raise PoolTimeout(
+                f'Нет свободного соединения ClickHouse за '
+                f'{self.acquire_timeout} с'
+            )
+        metrics.CLICKHOUSE_POOL_ACQUIRE_WAIT.observe(monotonic() - started_at)
+        try:
+            if self._free:
+                connection, _ = self._free.pop()
+            else:
+                connection = await self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+        self._used += 1
+        self._report()
+        healthy = False
+        try:
+            yield connection
+            healthy = True
+        finally:
+            self._used -= 1
+            if healthy:
+                self._free.append((connection, monotonic()))
+            else:
+                await self._discard(connection, 'error')
+            self._slots.release()
+            self._report()
+
+    async def _connect(self) -> Connection:
+        return await connect(**self.connection_kwargs)
+
+    async def _fill(self) -> None:
+        while len(self._free) + self._used < self.min_size:
+            self._free.append((await self._connect(), monotonic()))
+        self._report()
+
+    async def _discard(
+        self,
+        connection: Connection,
+        reason: Optional[str]
+    ) -> None:
+        if reason:
+            metrics.CLICKHOUSE_POOL_CLOSED_CONNECTIONS.labels(reason).inc()
+        try:
+            await connection.close()
+        except Exception as exception:
+            logger.debug('Ошибка закрытия соединения: %s', exception)
+
+    async def _check_health(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            try:
+                await self._check_idle()
+                await self._fill()
+            except Exception as exception:
+                logger.warning(
+                    'Проверка соединений ClickHouse не удалась: %s',
+                    exception
+                )
+
+    async def _check_idle(self) -> None:
+        idle_since = monotonic() - self.health_check_interval
+        idle = [item for item in self._free if item[1] <= idle_since]
+        self._free = [item for item in self._free if item[1] > idle_since]
+        keep = max(self.min_size - len(self._free) - self._used, 0)
+        for connection, _ in idle[keep:]:
+            await self._discard(connection, 'idle')
+        # Оставшиеся соединения ждут проверки в пуле, давно простаивающие
+        # в начале списка. Проверяемое соединение занимает место в пуле,
+        # как занятое запросом, иначе запросы откроют новые сверх max_size
+        self._free[:0] = idle[:keep]
+        for item in idle[:keep]:
+            # Соединение уже занял запрос или мест нет: проверка
+            # откладывается до следующего интервала
+            if item not in self._free or self._slots.locked():
+                continue
+            await self._slots.acquire()
+            self._free.remove(item)
+            connection = item[0]
+            try:
+                # Курсор не закрывается: в asynch это закрывает и
+                # соединение
+                await connection.cursor().execute('SELECT 1')
+            except Exception as exception:
+                logger.warning(
+                    'Соединение ClickHouse не прошло проверку: %s', exception
+                )
+                await self._discard(connection, 'health_check')
+            else:
+                self._free.append((connection, monotonic()))
+            finally:
+                self._slots.release()
+        self._report()
+
+    def _report(self) -> None:
+        metrics.CLICKHOUSE_POOL_CONNECTIONS.labels('idle').set(
+            len(self._free)
+        )
+        metrics.CLICKHOUSE_POOL_CONNECTIONS.labels('used').set(self._used)
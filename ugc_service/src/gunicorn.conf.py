@@ -0,0 +1,7 @@
+# Загружается gunicorn из рабочего каталога автоматически
+from core import metrics
+
+
+def child_exit(server, worker):
+    # Значения метрик завершившегося воркера не должны учитываться
+    metrics.mark_process_dead(worker.pid)
@@ -6,16 +6,19 @@ import sentry_sdk
 
 from async_fastapi_jwt_auth import AuthJWT
 from async_fastapi_jwt_auth.exceptions import AuthJWTException
+from core import metrics
 from core.config import settings
 from core.logger import LOGGING
-from db import mongo, olap, oltp
-from fastapi import FastAPI, Request
+from db import cache, mongo, olap, oltp
+from fastapi import FastAPI, Request, Response
 from fastapi.responses import ORJSONResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from services.users_films import get_userfilm_service
 from api.v1 import users_films, ratings, reviews, bookmarks
 from core.config import settings
 from core.middleware import RequestContextMiddleware
 from db import olap, oltp, mongo
+from db.buffer import WriteAheadBuffer
 
 
 logger = getLogger(__name__)
@@ -30,10 +33,31 @@ if settings.sentry_enabled:
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     olap.olap_bd = olap.ClickHouseOlap(
-        settings.clickhouse_host, settings.clickhouse_port
+        settings.clickhouse_host,
+        settings.clickhouse_port,
+        pool_min_size=settings.clickhouse_pool_min_size,
+        pool_max_size=settings.clickhouse_pool_max_size,
+        acquire_timeout=settings.clickhouse_pool_acquire_timeout,
+        health_check_interval=settings.clickhouse_pool_health_check_interval
     )
+    kafka_buffer = None
+    if settings.kafka_buffer_enabled:
+        kafka_buffer = WriteAheadBuffer(
+            settings.kafka_buffer_dir,
+            settings.kafka_buffer_memory_messages,
+            settings.kafka_buffer_disk_max_bytes
+        )
     oltp.oltp_bd = oltp.KafkaOltp(
-        f'{settings.kafka_host}:{settings.kafka_port}'
+        f'{settings.kafka_host}:{settings.kafka_port}',
+        linger_ms=settings.kafka_producer_linger_ms,
+        compression_type=settings.kafka_producer_compression,
+        max_batch_size=settings.kafka_producer_batch_size,
+        acks=settings.kafka_producer_acks,
+        max_in_flight=settings.kafka_producer_max_in_flight,
+        durability=settings.kafka_view_durability,
+        buffer=kafka_buffer,
+        enqueue_timeout=settings.kafka_buffer_enqueue_timeout,
+        retry_interval=settings.kafka_buffer_retry_interval
     )
     await oltp.oltp_bd.connect()
     await olap.olap_bd.connect()
@@ -41,8 +65,28 @@ async def lifespan(app: FastAPI):
         settings.mongodb_uri,
         uuidRepresentation='standard',
     )
+    if settings.users_films_cache_backend == 'memory':
+        cache.position_cache = cache.MemoryPositionCache(
+            settings.users_films_cache_ttl,
+            settings.users_films_cache_max_keys
+        )
+    elif settings.users_films_cache_backend == 'mongo':
+        cache.position_cache = cache.MongoPositionCache(
+            mongo.client, settings.users_films_cache_ttl
+        )
+    if cache.position_cache:
+        await cache.position_cache.connect()
     yield
+    # Тот же экземпляр, что получают обработчики запросов: FastAPI
+    # передает зависимости именованными аргументами в порядке параметров,
+    # а lru_cache различает позиционные и именованные аргументы
+    await get_userfilm_service(
+        olap=olap.olap_bd,
+        oltp=oltp.oltp_bd,
+        cache=cache.position_cache
+    ).close()
     await oltp.oltp_bd.disconnect()
+    await olap.olap_bd.disconnect()
     mongo.client.close()
 
 
@@ -70,6 +114,11 @@ def authjwt_exception_handler(request: Request, exc: AuthJWTException):
     )
 
 
+@app.get('/metrics', include_in_schema=False)
+def get_metrics():
+    return Response(metrics.latest(), media_type=metrics.CONTENT_TYPE_LATEST)
+
+
 if settings.sentry_enabled:
     app.add_middleware(RequestContextMiddleware)
 
@@ -2,11 +2,15 @@ from datetime import datetime
 from uuid import UUID
 
 from models.base import BaseModel
+from pydantic import Field
+
+# Позиции хранятся в ClickHouse в столбцах UInt16
+POSITION_MAX = 0xFFFF
 
 
 class UserFilmTimestamp(BaseModel):
     user_id: UUID
     film_id: UUID
-    start_time: int
-    end_time: int
+    start_time: int = Field(ge=0, le=POSITION_MAX)
+    end_time: int = Field(ge=0, le=POSITION_MAX)
     timestamp: datetime
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+from time import monotonic
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from models.users_films import UserFilmTimestamp
+
+logger = logging.getLogger(__name__)
+
+
+class HeartbeatCoalescer:
+    """Оставляет за окно window секунд только последнюю временную метку
+    пары (user_id, film_id).
+
+    Окно пары открывается первой меткой, по его истечении последняя метка
+    отправляется через flush. Перемотка - расхождение начала новой метки
+    с концом предыдущей больше jump секунд - отправляет метку сразу, как
+    и переполнение буфера max_keys парами.
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[List[UserFilmTimestamp]], Awaitable],
+        window: float,
+        jump: int,
+        max_keys: int
+    ) -> None:
+        self.flush = flush
+        self.window = window
+        self.jump = jump
+        self.max_keys = max_keys
+        # Окна открываются по порядку, поэтому сроки пар в словаре
+        # не убывают
+        self._pending: Dict[
+            Tuple[UUID, UUID], Tuple[float, UserFilmTimestamp]
+        ] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def add(self, user_film_data: UserFilmTimestamp) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        key = (user_film_data.user_id, user_film_data.film_id)
+        pending = self._pending.get(key)
+        if pending:
+            deadline, current = pending
+            if abs(user_film_data.start_time - current.end_time) > self.jump:
+                del self._pending[key]
+                await self.flush([user_film_data])
+            else:
+                self._pending[key] = (deadline, user_film_data)
+            return
+        if len(self._pending) >= self.max_keys:
+            await self.flush([user_film_data])
+            return
+        self._pending[key] = (monotonic() + self.window, user_film_data)
+
+    async def close(self) -> None:
+        """Отправляет все накопленные метки."""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self._flush_expired(None)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(min(self.window / 4, 1))
+            try:
+                await self._flush_expired(monotonic())
+            except Exception:
+                logger.exception('Не удалось отправить временные метки')
+
+    async def _flush_expired(self, now: Optional[float]) -> None:
+        expired = []
+        for key, (deadline, _) in self._pending.items():
+            if now is not None and deadline > now:
+                break
+            expired.append(key)
+        if not expired:
+            return
+        batch = [self._pending[key][1] for key in expired]
+        # Метки удаляются только после успешной отправки, иначе
+        # повторяются на следующем шаге. Метку, пришедшую во время
+        # отправки, пара сохраняет
+        await self.flush(batch)
+        for key, sent in zip(expired, batch):
+            pending = self._pending.get(key)
+            if pending is not None and pending[1] is sent:
+                del self._pending[key]
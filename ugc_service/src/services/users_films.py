@@ -1,39 +1,163 @@
+import asyncio
+import struct
 from functools import lru_cache
+from logging import getLogger
+from typing import List, Optional, Set
 from uuid import UUID
 
 from core.config import settings
+from core.metrics import POSITION_CACHE_ERRORS, POSITION_CACHE_REQUESTS
+from db.cache import GenericPositionCache, get_position_cache
 from db.olap import GenericOlap, get_olap
 from db.oltp import GenericOltp, get_oltp
 from fastapi import Depends
 from models.users_films import UserFilmTimestamp
+from services.coalescing import HeartbeatCoalescer
+from services.encoding import encode_view
+
+logger = getLogger(__name__)
 
 
 class UserFilmService:
-    def __init__(self, olap: GenericOlap, oltp: GenericOltp):
+    # Записей в кэш, выполняемых одновременно: если кэш не успевает,
+    # следующие метки в него не попадают
+    CACHE_MAX_WRITES = 1000
+
+    def __init__(
+        self,
+        olap: GenericOlap,
+        oltp: GenericOltp,
+        cache: Optional[GenericPositionCache] = None
+    ):
         self.olap = olap
         self.oltp = oltp
+        # Метки попадают в ClickHouse с задержкой Kafka и ETL, кэш
+        # отдает последнюю принятую сервисом позицию сразу
+        self.cache = cache
+        # Запись в кэш не задерживает ответ: ссылки на задачи хранятся,
+        # чтобы их не удалил сборщик мусора
+        self._cache_writes: Set[asyncio.Task] = set()
+        self.coalescer = None
+        if settings.users_films_coalesce_window:
+            self.coalescer = HeartbeatCoalescer(
+                self._write,
+                settings.users_films_coalesce_window,
+                settings.users_films_coalesce_jump,
+                settings.users_films_coalesce_max_keys
+            )
 
     async def create_user_film_timestamp(
         self,
         user_film_data: UserFilmTimestamp
     ):
-        return await self.oltp.write(
-            key=f'{user_film_data.user_id}+{user_film_data.film_id}',
-            data=user_film_data.json(),
+        if self.coalescer:
+            await self.coalescer.add(user_film_data)
+        else:
+            await self.oltp.write(
+                key=f'{user_film_data.user_id}+{user_film_data.film_id}',
+                data=encode_view(
+                    user_film_data, settings.kafka_view_encoding
+                ),
+                topic=settings.kafka_view_topic
+            )
+        self._remember_later([user_film_data])
+
+    async def create_user_film_timestamps(
+        self,
+        user_films_data: List[UserFilmTimestamp]
+    ):
+        if self.coalescer:
+            for user_film_data in user_films_data:
+                await self.coalescer.add(user_film_data)
+        else:
+            await self._write(user_films_data)
+        self._remember_later(user_films_data)
+
+    async def close(self) -> None:
+        if self.coalescer:
+            await self.coalescer.close()
+        if self._cache_writes:
+            await asyncio.gather(*self._cache_writes)
+
+    async def _write(self, user_films_data: List[UserFilmTimestamp]):
+        # Метка, которую нельзя закодировать, отбрасывается: иначе
+        # укрупнитель повторял бы отправку всего батча бесконечно
+        messages = []
+        for user_film_data in user_films_data:
+            try:
+                data = encode_view(
+                    user_film_data, settings.kafka_view_encoding
+                )
+            except (ValueError, struct.error) as exception:
+                logger.error(
+                    'Временная метка %s отброшена: %s',
+                    user_film_data, exception
+                )
+                continue
+            messages.append(
+                (f'{user_film_data.user_id}+{user_film_data.film_id}', data)
+            )
+        if not messages:
+            return None
+        return await self.oltp.write_batch(
+            messages=messages,
             topic=settings.kafka_view_topic
         )
 
     async def get_last_timestamp(self, user_id: UUID, film_id: UUID):
+        if self.cache:
+            try:
+                cached = await self.cache.get(user_id, film_id)
+            except Exception as exception:
+                logger.warning('Ошибка чтения кэша позиций: %s', exception)
+                POSITION_CACHE_ERRORS.labels('get').inc()
+                cached = None
+            if cached:
+                POSITION_CACHE_REQUESTS.labels('hit').inc()
+                return cached
+            POSITION_CACHE_REQUESTS.labels('miss').inc()
         timestamp = await self.olap.get_last_user_film_timestamp(
             user_id,
             film_id
         )
+        if timestamp:
+            self._remember_later([timestamp])
         return timestamp
 
+    def _remember_later(
+        self,
+        user_films_data: List[UserFilmTimestamp]
+    ) -> None:
+        if not self.cache:
+            return
+        if len(self._cache_writes) >= self.CACHE_MAX_WRITES:
+            POSITION_CACHE_ERRORS.labels('put').inc()
+            return
+        task = asyncio.get_running_loop().create_task(
+            self._remember(user_films_data)
+        )
+        self._cache_writes.add(task)
+        task.add_done_callback(self._cache_writes.discard)
+
+    async def _remember(
+        self,
+        user_films_data: List[UserFilmTimestamp]
+    ) -> None:
+        # Метка уже принята, ошибка кэша только лишает следующее чтение
+        # быстрого ответа
+        if not self.cache:
+            return
+        try:
+            await self.cache.put_many(user_films_data)
+        except Exception as exception:
+            logger.warning('Ошибка записи в кэш позиций: %s', exception)
+            POSITION_CACHE_ERRORS.labels('put').inc()
+
 
 @lru_cache()
 def get_userfilm_service(
     olap: GenericOlap = Depends(get_olap),
     oltp: GenericOltp = Depends(get_oltp),
+    cache: Optional[GenericPositionCache] = Depends(get_position_cache),
 ) -> UserFilmService:
-    return UserFilmService(olap, oltp)
+    return UserFilmService(olap, oltp, cache)
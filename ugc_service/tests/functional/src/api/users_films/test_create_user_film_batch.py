@@ -0,0 +1,85 @@
+from datetime import datetime
+from http import HTTPStatus
+from uuid import uuid4
+
+import pytest
+
+endpoint_url = '/users_films/batch'
+endpoint_method = 'post'
+
+
+def user_film_timestamp(user_id, start_time=0):
+    return {
+        'user_id': str(user_id),
+        'film_id': str(uuid4()),
+        'start_time': start_time,
+        'end_time': start_time + 10,
+        'timestamp': datetime.utcnow().isoformat(),
+    }
+
+
+def test_correct_authenticated_request_accepts_timestamps_with_code_200(
+        api_request,
+):
+    user_id = uuid4()
+
+    payload = [
+        user_film_timestamp(user_id, start_time)
+        for start_time in range(0, 1000, 10)
+    ]
+    response = api_request(
+        endpoint_method,
+        endpoint_url,
+        user_id=user_id,
+        json=payload,
+    )
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.json() == {'detail': 'ok'}
+
+
+def test_unauthenticated_request_results_in_error_401(api_request):
+    payload = [user_film_timestamp(uuid4())]
+    response = api_request(endpoint_method, endpoint_url, json=payload)
+
+    assert response.status_code == HTTPStatus.UNAUTHORIZED
+
+
+def test_timestamp_of_another_user_results_in_error_403(api_request):
+    user_id = uuid4()
+
+    payload = [
+        user_film_timestamp(user_id),
+        user_film_timestamp(uuid4()),
+    ]
+    response = api_request(
+        endpoint_method,
+        endpoint_url,
+        user_id=user_id,
+        json=payload,
+    )
+
+    assert response.status_code == HTTPStatus.FORBIDDEN
+
+
+@pytest.mark.parametrize(
+    ['payload'],
+    [
+        ([],),
+        ([{'film_id': str(uuid4())}],),
+        ({'user_id': str(uuid4())},),
+        ([user_film_timestamp(uuid4(), -10)],),
+        ([user_film_timestamp(uuid4(), 65530)],),
+    ],
+)
+def test_request_with_invalid_schema_results_in_error_422(api_request, payload):
+    user_id = uuid4()
+
+    response = api_request(
+        endpoint_method,
+        endpoint_url,
+        user_id=user_id,
+        json=payload,
+    )
+
+    assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
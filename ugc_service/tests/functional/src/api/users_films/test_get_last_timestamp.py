@@ -0,0 +1,60 @@
+from datetime import datetime, timedelta
+from http import HTTPStatus
+from uuid import uuid4
+
+endpoint_method = 'get'
+
+
+def endpoint_url(user_id, film_id):
+    return f'/users_films/{user_id}/{film_id}/last_timestamp'
+
+
+def user_film_timestamp(user_id, film_id, start_time, timestamp):
+    return {
+        'user_id': str(user_id),
+        'film_id': str(film_id),
+        'start_time': start_time,
+        'end_time': start_time + 10,
+        'timestamp': timestamp.isoformat(),
+    }
+
+
+def test_accepted_timestamp_is_returned_immediately(api_request):
+    user_id, film_id = uuid4(), uuid4()
+    timestamp = user_film_timestamp(user_id, film_id, 100, datetime.utcnow())
+    api_request('post', '/users_films/', user_id=user_id, json=timestamp)
+
+    response = api_request(
+        endpoint_method,
+        endpoint_url(user_id, film_id),
+        user_id=user_id,
+    )
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.json()['start_time'] == 100
+    assert response.json()['end_time'] == 110
+
+
+def test_older_timestamp_does_not_replace_newer(api_request):
+    user_id, film_id = uuid4(), uuid4()
+    now = datetime.utcnow()
+    payload = [
+        user_film_timestamp(user_id, film_id, 200, now),
+        user_film_timestamp(user_id, film_id, 100, now - timedelta(minutes=1)),
+    ]
+    api_request('post', '/users_films/batch', user_id=user_id, json=payload)
+
+    response = api_request(
+        endpoint_method,
+        endpoint_url(user_id, film_id),
+        user_id=user_id,
+    )
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.json()['start_time'] == 200
+
+
+def test_unauthenticated_request_results_in_error_401(api_request):
+    response = api_request(endpoint_method, endpoint_url(uuid4(), uuid4()))
+
+    assert response.status_code == HTTPStatus.UNAUTHORIZED
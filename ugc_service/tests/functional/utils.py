@@ -13,6 +13,7 @@ def get_jtw_token(user_id: UUID) -> str:
         'sub': str(user_id),
         'exp': now + timedelta(minutes=15).total_seconds(),
         'type': 'access',
+        'roles': [],
     }
     return jwt.encode(payload, key='test', algorithm='HS256')
 